@@ -6,21 +6,61 @@ Dynamic IoT Dashboard for Real-time Device Monitoring and Control
 """
 
 import tinytuya
+import argparse
+import asyncio
+import base64
+import bisect
 import time
 import json
 import csv
+import gzip
+import io
 import os
+import shutil
+import signal
 import threading
 import sqlite3
-from datetime import datetime, timedelta
+import struct
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
 from flask import Flask, render_template, jsonify, request, send_from_directory, Response
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from werkzeug.http import http_date
 import random
 import uuid
+import numpy as np
+import queue
+import zlib
+from multiprocessing import get_context, shared_memory
+from collections import OrderedDict
+from contextlib import contextmanager
+from operator import itemgetter
+from itertools import chain, islice, repeat
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+class EncodedJSON(str):
+    """JSON text encoded ahead of time, sent in Socket.IO packets as-is"""
+    __slots__ = ()
+
+class PacketJSON:
+    """json module for Socket.IO that splices EncodedJSON payloads in instead of re-encoding them"""
+    
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        if isinstance(obj, list) and any(isinstance(item, EncodedJSON) for item in obj):
+            return '[' + ','.join(
+                item if isinstance(item, EncodedJSON) else json.dumps(item, *args, **kwargs)
+                for item in obj
+            ) + ']'
+        return json.dumps(obj, *args, **kwargs)
+    
+    loads = staticmethod(json.loads)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'iot_dashboard_secret_key'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", json=PacketJSON)
 
 # Configuration
 REAL_DEVICE_CONFIG = {
@@ -30,15 +70,507 @@ REAL_DEVICE_CONFIG = {
     'version': 3.5
 }
 
+# Real device I/O: one asyncio task per device keeps a connection open and takes the status
+# the device pushes; a request gets POLL_DEADLINE seconds before the device is reported offline
+TUYA_PORT = 6668
+POLL_DEADLINE = 2.0  # seconds
+HEARTBEAT_INTERVAL = 10.0  # seconds of silence before a heartbeat; devices drop idle sockets after ~30s
+# Reconnects back off exponentially from the poll period up to DEVICE_BACKOFF_MAX. After
+# DEVICE_CIRCUIT_THRESHOLD failures in a row the device's circuit opens: it is reported
+# unreachable and only probed in the background until it answers again
+DEVICE_BACKOFF_MAX = 300.0  # seconds
+DEVICE_CIRCUIT_THRESHOLD = 3
+
+# Telemetry writer: ticks waiting for disk beyond TELEMETRY_QUEUE_TICKS are dropped,
+# and up to TELEMETRY_BATCH_TICKS queued ticks are written in a single transaction
+TELEMETRY_QUEUE_TICKS = 300
+TELEMETRY_BATCH_TICKS = 30
+HISTORY_RETENTION_DAYS = 7
+RETENTION_SWEEP_INTERVAL = 3600  # seconds
+
+# Rollup tiers kept alongside raw history: name -> (bucket seconds, retention days)
+ROLLUP_TIERS = {
+    '1m': (60, 7),
+    '15m': (900, 90),
+    '1h': (3600, 730)
+}
+ROLLUP_METRICS = ('voltage', 'current', 'power')
+HISTORY_LIMIT = 100  # rows returned when no window is requested
+HISTORY_MAX_POINTS = 5000  # upper bound for a chart's max_points
+RECENT_HISTORY_SAMPLES = 128  # ticks of raw history per device kept in memory for chart refreshes
+RECENT_HISTORY_DEVICES = 1024  # devices with such a ring, the most recently charted ones
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes of CSV buffered per streamed chunk
+
+# CSV log: one open file handle, flushed to disk every settings['csv_flush_interval'] seconds
+CSV_BUFFER_SIZE = 1024 * 1024  # bytes
+CSV_FLUSH_INTERVAL = 5  # seconds, default of the csv_flush_interval setting
+
+# REST reads answer revalidation by state version and cache compressed bodies per version
+COMPRESS_MIN_SIZE = 1024  # bytes; smaller bodies are sent uncompressed
+SERVER_INSTANCE = uuid.uuid4().hex[:8]  # in every ETag, so tags from before a restart never match
+
+# GET /api/devices listings: sortable fields are either config fields or a telemetry column
+DEVICE_PAGE_MAX = 1000  # largest limit a listing page may ask for
+DEVICE_SORT_CONFIG_FIELDS = ('id', 'name', 'type', 'location')
+DEVICE_SORT_COLUMNS = {
+    'status': 'online', 'state': 'state', 'voltage': 'voltage', 'current': 'current', 'power': 'power',
+    'energy': 'energy', 'temperature': 'temperature', 'humidity': 'humidity', 'cost_today': 'cost_today',
+    'uptime': 'uptime', 'last_updated': 'last_updated', 'failures': 'failures'
+}
+
+# Socket.IO backpressure: a client with CLIENT_QUEUE_LIMIT packets still waiting in its outbound
+# queue gets no more frames until it drains, then one full frame with the latest state
+CLIENT_QUEUE_LIMIT = 8
+
+# Hot-path metrics served at /metrics in Prometheus text format
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0)  # seconds
+
+# Update loop cadence: ticks start on fixed slots of the monotonic clock. A tick that runs
+# past its next slot either skips the missed slots ('skip') or runs one late tick covering
+# them right away ('coalesce').
+TICK_OVERRUN_POLICY = 'skip'
+# Seconds between samples per device type, e.g. {'Smart Bulb': 10}; a device's own
+# poll_interval overrides this, and types not listed are sampled every tick
+TYPE_POLL_INTERVALS = {}
+
+# Device state is written only by the update loop; API changes are queued for it
+UPDATE_COMMAND_TIMEOUT = 10  # seconds a request waits for the loop to apply its change
+
+# Split run mode (--split): an ingest process owns the update loop and writes every published
+# snapshot into a shared-memory ring; web worker processes serve clients from the ring and
+# forward writes to the ingest process's API on the loopback interface
+SHARED_RING_SLOTS = 4
+SHARED_SLOT_BYTES = 4 * 1024 * 1024  # initial slot size; the ring grows when a snapshot outgrows it
+SHARED_POLL_INTERVAL = 0.05  # seconds between web worker checks for a new snapshot
+INGEST_PORT = 5099
+
+# Device store: identity and configuration live in slotted DeviceRecords, hot
+# telemetry lives in one typed array per field indexed by the record's row
+DEVICE_CONFIG_FIELDS = ('id', 'name', 'type', 'location', 'ip_address', 'tuya_device_id',
+                        'local_key', 'tuya_version', 'is_real', 'poll_interval')
+# Config fields with a secondary index of rows per value; status needs none, the online column is one
+DEVICE_INDEXED_FIELDS = ('location', 'type')
+DEVICE_TELEMETRY_DEFAULTS = {
+    'status': 'offline',
+    'state': False,
+    'voltage': 0.0,
+    'current': 0.0,
+    'power': 0.0,
+    'energy': 0.0,
+    'temperature': 25.0,
+    'humidity': 60.0,
+    'cost_today': 0.0,
+    'uptime': 0,
+    'circuit': 'closed',
+    'failures': 0,
+    'retry_at': 0.0
+}
+DEVICE_COLUMNS = {
+    'online': np.bool_,
+    'state': np.bool_,
+    'voltage': np.float64,
+    'current': np.float64,
+    'power': np.float64,
+    'energy': np.float64,
+    'temperature': np.float64,
+    'humidity': np.float64,
+    'cost_today': np.float64,
+    'uptime': np.int64,
+    'last_updated': np.float64,  # epoch seconds
+    'type_code': np.int8,
+    'is_real': np.bool_,
+    'alive': np.bool_,
+    'generation': np.int64,      # bumped whenever a row's identity or metadata changes
+    'poll_every': np.float64,    # seconds between samples, 0 for every tick
+    'next_poll': np.float64,     # time.monotonic() when the device is next due
+    'circuit': np.int8,          # index into CIRCUIT_STATES
+    'failures': np.int32,        # consecutive failed connection attempts
+    'retry_at': np.float64       # epoch seconds of the next reconnect attempt, 0 when connected
+}
+CIRCUIT_STATES = ('closed', 'open', 'half_open')
+# Order of keys in serialized devices
+DEVICE_SERIALIZED_FIELDS = (
+    'id', 'name', 'type', 'location', 'ip_address', 'tuya_device_id', 'local_key', 'tuya_version',
+    'poll_interval', 'status', 'state', 'voltage', 'current', 'power', 'energy', 'temperature', 'humidity',
+    'last_updated', 'is_real', 'cost_today', 'uptime', 'circuit', 'failures', 'retry_at'
+)
+
+def _telemetry_property(column):
+    def getter(self):
+        return self.store.columns[column][self.row].item()
+    def setter(self, value):
+        self.store.columns[column][self.row] = value
+    return property(getter, setter)
+
+class DeviceRecord:
+    """One device's identity and configuration; telemetry reads and writes go to the store's arrays"""
+    __slots__ = DEVICE_CONFIG_FIELDS + ('row', 'store')
+
+    state = _telemetry_property('state')
+    voltage = _telemetry_property('voltage')
+    current = _telemetry_property('current')
+    power = _telemetry_property('power')
+    energy = _telemetry_property('energy')
+    temperature = _telemetry_property('temperature')
+    humidity = _telemetry_property('humidity')
+    cost_today = _telemetry_property('cost_today')
+    uptime = _telemetry_property('uptime')
+    failures = _telemetry_property('failures')
+    retry_at = _telemetry_property('retry_at')
+
+    @property
+    def status(self):
+        return 'online' if self.store.columns['online'][self.row] else 'offline'
+
+    @status.setter
+    def status(self, value):
+        self.store.columns['online'][self.row] = value == 'online'
+
+    @property
+    def circuit(self):
+        return CIRCUIT_STATES[self.store.columns['circuit'][self.row]]
+
+    @circuit.setter
+    def circuit(self, value):
+        self.store.columns['circuit'][self.row] = CIRCUIT_STATES.index(value)
+
+    @property
+    def last_updated(self):
+        return datetime.fromtimestamp(self.store.columns['last_updated'][self.row])
+
+    @last_updated.setter
+    def last_updated(self, value):
+        self.store.columns['last_updated'][self.row] = value.timestamp()
+
+    def config(self):
+        """Fields persisted in the devices table"""
+        return {field: getattr(self, field) for field in DEVICE_CONFIG_FIELDS}
+
+class DeviceStore:
+    """All devices: a dict-like index of DeviceRecords over contiguous telemetry columns"""
+
+    def __init__(self, capacity=1024):
+        self.lock = threading.RLock()
+        self.index = {}
+        self.records = []
+        self.free_rows = []
+        self.size = 0  # rows ever handed out; live rows are marked in the alive column
+        self.columns = {}
+        self.ids = np.empty(0, dtype=object)
+        self.indexes = {field: {} for field in DEVICE_INDEXED_FIELDS}  # field -> value -> set of rows
+        self.frozen_indexes = {field: {} for field in DEVICE_INDEXED_FIELDS}
+        self.stale_index_values = set()  # (field, value) pairs whose frozen rows are out of date
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        for name, dtype in DEVICE_COLUMNS.items():
+            grown = np.zeros(capacity, dtype=dtype)
+            if name in self.columns:
+                grown[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = grown
+        ids = np.empty(capacity, dtype=object)
+        ids[:self.size] = self.ids[:self.size]
+        self.ids = ids
+        self.records.extend([None] * (capacity - len(self.records)))
+        self.capacity = capacity
+
+    def add(self, config, last_updated=None, **telemetry):
+        """Create a device from its config fields; telemetry not given takes the defaults"""
+        with self.lock:
+            if config['id'] in self.index:
+                self.remove(config['id'])
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                if self.size == self.capacity:
+                    self._allocate(self.capacity * 2)
+                row = self.size
+                self.size += 1
+
+            record = DeviceRecord()
+            for field in DEVICE_CONFIG_FIELDS:
+                setattr(record, field, config.get(field))
+            record.is_real = bool(record.is_real)
+            record.row = row
+            record.store = self
+            self.records[row] = record
+            self.index[record.id] = record
+            self.ids[row] = record.id
+
+            values = dict(DEVICE_TELEMETRY_DEFAULTS, **telemetry)
+            for field, value in values.items():
+                setattr(record, field, value)
+            record.last_updated = last_updated or datetime.now()
+            self.columns['is_real'][row] = record.is_real
+            self.columns['alive'][row] = True
+            self.columns['next_poll'][row] = 0.0
+            self._index(record)
+            self.touch(record)
+            return record
+
+    def update(self, device_id, **config):
+        """Change config fields by swapping in a new record, so published snapshots keep the old one"""
+        with self.lock:
+            previous = self.index[device_id]
+            record = DeviceRecord()
+            for field in DEVICE_CONFIG_FIELDS:
+                setattr(record, field, config.get(field, getattr(previous, field)))
+            record.row = previous.row
+            record.store = self
+            self.records[record.row] = record
+            self.index[device_id] = record
+            self._unindex(previous)
+            self._index(record)
+            self.columns['next_poll'][record.row] = 0.0  # a new poll interval applies right away
+            self.touch(record)
+            return record
+
+    def touch(self, record):
+        """Note a metadata change (name, type, location) so it reaches clients and derived state"""
+        with self.lock:
+            self.columns['type_code'][record.row] = SIM_TYPE_CODES.get(record.type, SIM_UNKNOWN_TYPE)
+            self.columns['poll_every'][record.row] = record.poll_interval or TYPE_POLL_INTERVALS.get(record.type, 0.0)
+            self.columns['generation'][record.row] += 1
+
+    def remove(self, device_id):
+        with self.lock:
+            record = self.index.pop(device_id, None)
+            if record is None:
+                return None
+            self.columns['alive'][record.row] = False
+            self.columns['online'][record.row] = False
+            self.columns['generation'][record.row] += 1
+            self.records[record.row] = None
+            self.ids[record.row] = None
+            self.free_rows.append(record.row)
+            self._unindex(record)
+            return record
+
+    def _index(self, record):
+        for field in DEVICE_INDEXED_FIELDS:
+            value = getattr(record, field)
+            self.indexes[field].setdefault(value, set()).add(record.row)
+            self.stale_index_values.add((field, value))
+
+    def _unindex(self, record):
+        for field in DEVICE_INDEXED_FIELDS:
+            value = getattr(record, field)
+            rows = self.indexes[field][value]
+            rows.discard(record.row)
+            if not rows:
+                del self.indexes[field][value]
+            self.stale_index_values.add((field, value))
+
+    def freeze_indexes(self):
+        """{field: {value: sorted rows}} of the secondary indexes for a snapshot. Only values whose rows
+        changed since the last call are re-sorted, and a fresh outer dict is made only when one did,
+        so snapshots already handed out keep theirs unchanged."""
+        with self.lock:
+            if self.stale_index_values:
+                frozen = {field: dict(values) for field, values in self.frozen_indexes.items()}
+                for field, value in self.stale_index_values:
+                    rows = self.indexes[field].get(value)
+                    if rows:
+                        frozen[field][value] = np.array(sorted(rows), dtype=np.int64)
+                    else:
+                        frozen[field].pop(value, None)
+                self.frozen_indexes = frozen
+                self.stale_index_values.clear()
+            return self.frozen_indexes
+
+    def live_rows(self):
+        return np.flatnonzero(self.columns['alive'][:self.size])
+
+    def serialize(self, rows=None, columns=None, records=None):
+        """Build {device_id: dict} for rows straight from the column arrays (or a snapshot of them)"""
+        columns = columns or self.columns
+        records = self.records if records is None else records
+        rows = self.live_rows() if rows is None else rows
+        last_updated_iso = {}
+        def iso(epoch):
+            value = last_updated_iso.get(epoch)
+            if value is None:
+                value = last_updated_iso[epoch] = datetime.fromtimestamp(epoch).isoformat()
+            return value
+
+        values = zip(
+            rows.tolist(), columns['online'][rows].tolist(), columns['state'][rows].tolist(),
+            columns['voltage'][rows].tolist(), columns['current'][rows].tolist(),
+            columns['power'][rows].tolist(), columns['energy'][rows].tolist(),
+            columns['temperature'][rows].tolist(), columns['humidity'][rows].tolist(),
+            columns['last_updated'][rows].tolist(), columns['cost_today'][rows].tolist(),
+            columns['uptime'][rows].tolist(), columns['circuit'][rows].tolist(),
+            columns['failures'][rows].tolist(), columns['retry_at'][rows].tolist()
+        )
+        serialized = {}
+        for (row, online, state, voltage, current, power, energy, temperature, humidity, last_updated, cost, uptime,
+             circuit, failures, retry_at) in values:
+            record = records[row]
+            if record is None:
+                continue
+            serialized[record.id] = {
+                'id': record.id,
+                'name': record.name,
+                'type': record.type,
+                'location': record.location,
+                'ip_address': record.ip_address,
+                'tuya_device_id': record.tuya_device_id,
+                'local_key': record.local_key,
+                'tuya_version': record.tuya_version,
+                'poll_interval': record.poll_interval,
+                'status': 'online' if online else 'offline',
+                'state': state,
+                'voltage': voltage,
+                'current': current,
+                'power': power,
+                'energy': energy,
+                'temperature': temperature,
+                'humidity': humidity,
+                'last_updated': iso(last_updated),
+                'is_real': record.is_real,
+                'cost_today': cost,
+                'uptime': uptime,
+                'circuit': CIRCUIT_STATES[circuit],
+                'failures': failures,
+                'retry_at': iso(retry_at) if retry_at else None
+            }
+        return serialized
+
+    # dict-style access by device id
+    def __contains__(self, device_id):
+        return device_id in self.index
+
+    def __getitem__(self, device_id):
+        return self.index[device_id]
+
+    def get(self, device_id, default=None):
+        return self.index.get(device_id, default)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def keys(self):
+        return list(self.index)
+
+    def values(self):
+        return list(self.index.values())
+
+    def items(self):
+        return list(self.index.items())
+
+class LatencyHistogram:
+    """Latency histogram with fixed buckets; observe() is a bisect and two additions"""
+    
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+    
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+    
+    def read(self):
+        with self.lock:
+            return list(self.counts), self.total
+    
+    def render(self, name, labels=''):
+        """Prometheus _bucket/_sum/_count lines; labels is e.g. 'stage="poll"'"""
+        counts, total = self.read()
+        prefix = labels + ',' if labels else ''
+        suffix = '{' + labels + '}' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{suffix} {total}')
+        lines.append(f'{name}_count{suffix} {cumulative}')
+        return lines
+
+class Metrics:
+    """Per-stage tick latency and hot-path counters"""
+    
+    STAGES = ('tick', 'poll', 'simulate', 'csv', 'db', 'serialize', 'share', 'emit')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.tick_lag = LatencyHistogram()
+        self.last_tick_lag = 0.0
+        self.tick_overruns = 0
+        self.ticks_skipped = 0
+        self.emitted_frames = 0
+        self.emitted_bytes = 0
+        self.dropped_frames = 0
+        self.poll_failures = 0
+        self.clients = 0
+    
+    @contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage].observe(time.perf_counter() - started)
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+    
+    def render(self, counters=(), gauges=()):
+        """Prometheus text exposition; counters and gauges add (name, help, value) samples read at scrape time"""
+        lines = [
+            '# HELP iot_tick_stage_seconds Time spent in each stage of the device update tick.',
+            '# TYPE iot_tick_stage_seconds histogram'
+        ]
+        for stage, histogram in self.stage_seconds.items():
+            lines += histogram.render('iot_tick_stage_seconds', f'stage="{stage}"')
+        lines += [
+            '# HELP iot_tick_lag_seconds How late each tick started relative to its scheduled slot.',
+            '# TYPE iot_tick_lag_seconds histogram'
+        ] + self.tick_lag.render('iot_tick_lag_seconds')
+        
+        with self.lock:
+            counters = (
+                ('iot_tick_overruns_total', 'Ticks that ran past the start of the next slot.', self.tick_overruns),
+                ('iot_ticks_skipped_total', 'Scheduled tick slots skipped or coalesced after an overrun.',
+                 self.ticks_skipped),
+                ('iot_emitted_frames_total', 'device_update frames broadcast.', self.emitted_frames),
+                ('iot_emitted_bytes_total', 'Bytes of device_update frames sent, summed over clients.',
+                 self.emitted_bytes),
+                ('iot_dropped_frames_total', 'device_update frames skipped for clients with a full outbound queue.',
+                 self.dropped_frames),
+                ('iot_poll_failures_total', 'Tuya status polls that failed or missed the deadline.',
+                 self.poll_failures)
+            ) + tuple(counters)
+            clients = self.clients
+        for name, help_text, value in counters:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {value}']
+        for name, help_text, value in (('iot_socketio_clients', 'Connected Socket.IO clients.', clients),) + tuple(gauges):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
 # Global variables
-devices_data = {}
+devices_data = DeviceStore()
 historical_data = []
-real_device = None
+update_commands = queue.Queue()  # (Future, callable, args) applied by the update loop
+metrics = Metrics()
+settings_version = 0             # bumped on every settings change, for ETags
+settings_modified = time.time()
 device_start_time = datetime.now()
 settings = {
     'electricity_rate': 8.0,  # BDT per kWh
     'update_interval': 1,     # seconds
-    'file_size_limit': 2      # MB
+    'file_size_limit': 2,     # MB
+    'csv_flush_interval': CSV_FLUSH_INTERVAL  # seconds
 }
 
 # Database setup
@@ -58,10 +590,19 @@ def init_database():
             device_id TEXT,
             local_key TEXT,
             is_real BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            version REAL,
+            poll_interval REAL
         )
     ''')
-    
+
+    # Databases created before per-device protocol versions were stored
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(devices)')]
+    if 'version' not in columns:
+        cursor.execute('ALTER TABLE devices ADD COLUMN version REAL')
+    if 'poll_interval' not in columns:
+        cursor.execute('ALTER TABLE devices ADD COLUMN poll_interval REAL')
+
     # Create settings table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS settings (
@@ -71,35 +612,198 @@ def init_database():
         )
     ''')
     
-    # Create historical_data table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS historical_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+    # Historical data lives in one table per UTC day (see history_table_name)
+    migrate_historical_data(cursor)
+    
+    # Create rollup tables
+    for tier in ROLLUP_TIERS:
+        metric_columns = ''.join(
+            f'{metric}_min REAL, {metric}_max REAL, {metric}_mean REAL, {metric}_last REAL, '
+            for metric in ROLLUP_METRICS
+        )
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS rollup_{tier} (
+                device_id TEXT NOT NULL,
+                bucket TIMESTAMP NOT NULL,
+                samples INTEGER NOT NULL,
+                {metric_columns}
+                energy_delta REAL,
+                energy_last REAL,
+                PRIMARY KEY (device_id, bucket)
+            ) WITHOUT ROWID
+        ''')
+    
+    conn.commit()
+    conn.close()
+
+# Historical data storage: one historical_data_YYYYMMDD table per UTC day, each
+# indexed on (device_id, timestamp). Retention drops whole expired days.
+def history_table_name(timestamp):
+    """Day table holding a 'YYYY-MM-DD HH:MM:SS' timestamp"""
+    return f"historical_data_{timestamp[:10].replace('-', '')}"
+
+def create_history_table(cursor, table):
+    """Create a day table and its per-device time index if missing"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
             device_id TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            timestamp TIMESTAMP NOT NULL,
             voltage REAL,
             current REAL,
             power REAL,
             energy REAL,
-            cost REAL,
-            FOREIGN KEY (device_id) REFERENCES devices (id)
+            cost REAL
         )
     ''')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_device_time ON {table} (device_id, timestamp)')
+
+def list_history_tables(cursor, start=None, end=None):
+    """Day tables, oldest first, that can hold rows between start and end"""
+    cursor.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name GLOB 'historical_data_[0-9]*'
+        ORDER BY name
+    ''')
+    tables = [row[0] for row in cursor.fetchall()]
+    if start:
+        tables = [table for table in tables if table >= history_table_name(start)]
+    if end:
+        tables = [table for table in tables if table <= history_table_name(end)]
+    return tables
+
+def drop_expired_history_tables(cursor, now=None):
+    """Drop day tables that fall entirely outside the retention window"""
+    now = now or datetime.now(timezone.utc)
+    cutoff = history_table_name((now - timedelta(days=HISTORY_RETENTION_DAYS)).strftime('%Y-%m-%d'))
+    expired = [table for table in list_history_tables(cursor) if table < cutoff]
+    for table in expired:
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+    return expired
+
+def migrate_historical_data(cursor):
+    """Move rows from the old single historical_data table into day tables"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'historical_data'")
+    if not cursor.fetchone():
+        return
     
-    conn.commit()
-    conn.close()
+    print("Migrating historical data to daily tables...")
+    # One index build makes each day's range copy below a seek instead of a scan
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_historical_data_timestamp ON historical_data (timestamp)')
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=HISTORY_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    cursor.execute('''
+        SELECT DISTINCT substr(timestamp, 1, 10) FROM historical_data
+        WHERE timestamp >= ? ORDER BY 1
+    ''', (cutoff,))
+    days = [row[0] for row in cursor.fetchall()]
+    
+    for day in days:
+        table = history_table_name(day)
+        next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        create_history_table(cursor, table)
+        cursor.execute(f'''
+            INSERT INTO {table} (device_id, timestamp, voltage, current, power, energy, cost)
+            SELECT device_id, timestamp, voltage, current, power, energy, cost
+            FROM historical_data
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp
+        ''', (day, next_day))
+    
+    cursor.execute('DROP TABLE historical_data')
+    print(f"✓ Migrated {len(days)} day(s) of historical data")
+
+def normalize_timestamp(value):
+    """Convert an ISO date/datetime query value to the stored format, which is UTC. Values with an
+    offset (e.g. Date.toISOString()'s trailing Z) are converted; values without one are taken as UTC."""
+    if not value:
+        return value
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+def choose_resolution(resolution, start=None, end=None, points=HISTORY_LIMIT):
+    """Resolve 'auto' to the coarsest tier that still gives `points` points over the window"""
+    if resolution != 'auto':
+        return resolution
+    if not (start and end):
+        return 'raw'
+    window = (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+    for tier, (seconds, _) in sorted(ROLLUP_TIERS.items(), key=lambda item: -item[1][0]):
+        if window / seconds >= points:
+            return tier
+    return 'raw'
+
+def decimate_history(rows, start, end, max_points, low, high):
+    """Downsample oldest-first history rows to at most max_points, keeping their shape: the window is
+    cut into max_points // 2 equal time buckets and each bucket keeps only its rows with the lowest
+    and highest value, in time order. One pass holding a single bucket, so the cursor is never
+    materialized and peaks survive however wide the window is."""
+    origin = datetime.fromisoformat(start)
+    buckets = max(max_points // 2, 1)
+    width = max((datetime.fromisoformat(end) - origin).total_seconds(), 1) / buckets
+    current = lowest = highest = None
+    for row in rows:
+        bucket = min(int((datetime.fromisoformat(row[0]) - origin).total_seconds() // width), buckets - 1)
+        if bucket != current:
+            if lowest is not None:
+                yield from sorted({id(lowest): lowest, id(highest): highest}.values(), key=lambda kept: kept[0])
+            current, lowest, highest = bucket, row, row
+            continue
+        if (low(row) or 0) < (low(lowest) or 0):
+            lowest = row
+        if (high(row) or 0) > (high(highest) or 0):
+            highest = row
+    if lowest is not None:
+        yield from sorted({id(lowest): lowest, id(highest): highest}.values(), key=lambda kept: kept[0])
+
+def iter_rollup_history(cursor, tier, device_id, start=None, end=None, newest_first=False):
+    """Yield (bucket, voltage, current, power, energy, power_min, power_max, energy_delta) rows of a rollup tier"""
+    query = f'''
+        SELECT bucket, voltage_mean, current_mean, power_mean, energy_last,
+               power_min, power_max, energy_delta
+        FROM rollup_{tier}
+        WHERE device_id = ?
+    '''
+    params = [device_id]
+    if start and end:
+        query += ' AND bucket BETWEEN ? AND ?'
+        params.extend([start, end])
+    query += f" ORDER BY bucket {'DESC' if newest_first else 'ASC'}"
+    yield from cursor.execute(query, params)
+
+def iter_device_history(cursor, device_id, columns, start=None, end=None, newest_first=False):
+    """Yield history rows for one device across day tables, in timestamp order"""
+    order = 'DESC' if newest_first else 'ASC'
+    tables = list_history_tables(cursor, start, end)
+    if newest_first:
+        tables.reverse()
+    
+    for table in tables:
+        query = f'SELECT {columns} FROM {table} WHERE device_id = ?'
+        params = [device_id]
+        if start and end:
+            query += ' AND timestamp BETWEEN ? AND ?'
+            params.extend([start, end])
+        query += f' ORDER BY timestamp {order}'
+        yield from cursor.execute(query, params)
 
 def load_devices_from_db():
     """Load devices from database"""
     conn = sqlite3.connect('iot_dashboard.db')
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM devices')
+    cursor.execute('''
+        SELECT id, name, type, location, ip_address, device_id, local_key, is_real, version, poll_interval
+        FROM devices
+    ''')
     rows = cursor.fetchall()
     conn.close()
     
     for row in rows:
-        device_id, name, device_type, location, ip_address, tuya_device_id, local_key, is_real, created_at = row
-        devices_data[device_id] = {
+        (device_id, name, device_type, location, ip_address, tuya_device_id, local_key, is_real,
+         version, poll_interval) = row
+        devices_data.add({
             'id': device_id,
             'name': name,
             'type': device_type,
@@ -107,19 +811,10 @@ def load_devices_from_db():
             'ip_address': ip_address,
             'tuya_device_id': tuya_device_id,
             'local_key': local_key,
-            'status': 'offline',
-            'state': False,
-            'voltage': 0.0,
-            'current': 0.0,
-            'power': 0.0,
-            'energy': 0.0,
-            'temperature': 25.0,
-            'humidity': 60.0,
-            'last_updated': datetime.now(),
-            'is_real': bool(is_real),
-            'cost_today': 0.0,
-            'uptime': 0
-        }
+            'tuya_version': version or REAL_DEVICE_CONFIG['version'],
+            'is_real': is_real,
+            'poll_interval': poll_interval
+        })
 
 def load_settings_from_db():
     """Load settings from database"""
@@ -146,13 +841,14 @@ def save_device_to_db(device_data):
     cursor = conn.cursor()
     cursor.execute('''
         INSERT OR REPLACE INTO devices 
-        (id, name, type, location, ip_address, device_id, local_key, is_real)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        (id, name, type, location, ip_address, device_id, local_key, is_real, version, poll_interval)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         device_data['id'], device_data['name'], device_data['type'],
         device_data['location'], device_data.get('ip_address'),
         device_data.get('tuya_device_id'), device_data.get('local_key'),
-        device_data.get('is_real', False)
+        device_data.get('is_real', False), device_data.get('tuya_version'),
+        device_data.get('poll_interval')
     ))
     conn.commit()
     conn.close()
@@ -162,7 +858,10 @@ def delete_device_from_db(device_id):
     conn = sqlite3.connect('iot_dashboard.db')
     cursor = conn.cursor()
     cursor.execute('DELETE FROM devices WHERE id = ?', (device_id,))
-    cursor.execute('DELETE FROM historical_data WHERE device_id = ?', (device_id,))
+    for table in list_history_tables(cursor):
+        cursor.execute(f'DELETE FROM {table} WHERE device_id = ?', (device_id,))
+    for tier in ROLLUP_TIERS:
+        cursor.execute(f'DELETE FROM rollup_{tier} WHERE device_id = ?', (device_id,))
     conn.commit()
     conn.close()
 
@@ -178,15 +877,676 @@ def save_settings_to_db():
     conn.commit()
     conn.close()
 
-def serialize_device_data(devices):
-    """Convert datetime objects to strings for JSON serialization"""
-    serializable_devices = {}
-    for device_id, device in devices.items():
-        serializable_device = device.copy()
-        if isinstance(serializable_device.get('last_updated'), datetime):
-            serializable_device['last_updated'] = serializable_device['last_updated'].isoformat()
-        serializable_devices[device_id] = serializable_device
-    return serializable_devices
+def build_device_delta(previous, current, rows, records):
+    """Return (changed fields per device, removed device ids) between two column snapshots"""
+    changed = {}
+    ids = current['ids']
+    
+    # Rows that are new, reused by another device, or whose metadata changed go out in full
+    fresh = np.ones(len(rows), dtype=bool)
+    known = rows < len(previous['alive'])
+    known_rows = rows[known]
+    fresh[known] = ~previous['alive'][known_rows] | (previous['generation'][known_rows] != current['generation'][known_rows])
+    fresh_rows = rows[fresh]
+    changed.update(devices_data.serialize(fresh_rows, current, records))
+    
+    same_rows = rows[~fresh]
+    for column, field in (('online', 'status'), ('state', 'state'), ('voltage', 'voltage'),
+                          ('current', 'current'), ('power', 'power'), ('energy', 'energy'),
+                          ('temperature', 'temperature'), ('humidity', 'humidity'),
+                          ('last_updated', 'last_updated'), ('cost_today', 'cost_today'),
+                          ('uptime', 'uptime'), ('circuit', 'circuit'), ('failures', 'failures'),
+                          ('retry_at', 'retry_at')):
+        values = current[column][same_rows]
+        moved = np.flatnonzero(values != previous[column][same_rows])
+        if not len(moved):
+            continue
+        moved_values = values[moved].tolist()
+        if column == 'online':
+            moved_values = ['online' if value else 'offline' for value in moved_values]
+        elif column == 'last_updated':
+            moved_values = [datetime.fromtimestamp(value).isoformat() for value in moved_values]
+        elif column == 'circuit':
+            moved_values = [CIRCUIT_STATES[value] for value in moved_values]
+        elif column == 'retry_at':
+            moved_values = [datetime.fromtimestamp(value).isoformat() if value else None for value in moved_values]
+        for row, value in zip(same_rows[moved].tolist(), moved_values):
+            changed.setdefault(ids[row], {})[field] = value
+    
+    # Rows alive last frame that are gone or now hold another device (the store never shrinks)
+    gone = np.flatnonzero(previous['alive'])
+    gone = gone[~current['alive'][gone] | (current['generation'][gone] != previous['generation'][gone])]
+    removed = [previous['ids'][row] for row in gone.tolist()]
+    removed = [device_id for device_id in removed if device_id not in changed]
+    return changed, removed
+
+class DeviceSnapshot:
+    """Read-only fleet state published once per tick; its JSON is encoded at most once and shared"""
+    
+    def __init__(self, version, timestamp, modified, columns, records, statistics, indexes=None):
+        self.version = version
+        self.timestamp = timestamp
+        self.modified = modified  # epoch seconds, for Last-Modified
+        self.columns = columns
+        self.records = records
+        self.statistics = statistics
+        self.statistics_json = json.dumps(statistics)
+        self.timestamp_json = json.dumps(timestamp)
+        self._lock = threading.Lock()
+        self._devices_json = None
+        self._index = None
+        self._secondary_indexes = indexes
+    
+    @classmethod
+    def capture(cls, version, current_time, statistics):
+        """Copy the store's columns and record list so the snapshot stays fixed while the store moves on"""
+        with devices_data.lock:
+            size = devices_data.size
+            columns = {name: column[:size].copy() for name, column in devices_data.columns.items()}
+            columns['ids'] = devices_data.ids[:size].copy()
+            records = devices_data.records[:size]
+            indexes = devices_data.freeze_indexes()
+        for column in columns.values():
+            column.flags.writeable = False
+        return cls(version, current_time.isoformat(), current_time.timestamp(), columns, records, statistics, indexes)
+    
+    @classmethod
+    def empty(cls):
+        columns = {name: np.zeros(0, dtype=dtype) for name, dtype in DEVICE_COLUMNS.items()}
+        columns['ids'] = np.empty(0, dtype=object)
+        return cls(0, None, time.time(), columns, [], {})
+    
+    def live_rows(self):
+        return np.flatnonzero(self.columns['alive'])
+    
+    def index(self):
+        """{device_id: record} for this snapshot, built on first use"""
+        with self._lock:
+            if self._index is None:
+                self._index = {record.id: record for record in self.records if record is not None}
+            return self._index
+    
+    def find(self, device_id):
+        return self.index().get(device_id)
+    
+    def secondary_indexes(self):
+        """{field: {value: sorted rows}} for DEVICE_INDEXED_FIELDS; the store's when captured, else built on first use"""
+        with self._lock:
+            if self._secondary_indexes is None:
+                indexes = {field: {} for field in DEVICE_INDEXED_FIELDS}
+                for row, record in enumerate(self.records):
+                    if record is not None:
+                        for field in DEVICE_INDEXED_FIELDS:
+                            indexes[field].setdefault(getattr(record, field), []).append(row)
+                self._secondary_indexes = {
+                    field: {value: np.array(rows, dtype=np.int64) for value, rows in values.items()}
+                    for field, values in indexes.items()
+                }
+            return self._secondary_indexes
+    
+    def select_rows(self, location=None, device_type=None, status=None):
+        """Live rows matching every filter given, narrowed through the secondary indexes"""
+        indexes = self.secondary_indexes()
+        rows = None
+        for field, value in (('location', location), ('type', device_type)):
+            if value is None:
+                continue
+            matches = indexes[field].get(value, np.empty(0, dtype=np.int64))
+            rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+        if rows is None:
+            rows = self.live_rows()
+        if status is not None:
+            rows = rows[self.columns['online'][rows] == (status == 'online')]
+        return rows
+    
+    def devices_json(self):
+        """{device_id: device} for the whole fleet, encoded on first use"""
+        with self._lock:
+            if self._devices_json is None:
+                devices = devices_data.serialize(self.live_rows(), self.columns, self.records)
+                self._devices_json = json.dumps(devices)
+            return self._devices_json
+    
+    def full_frame(self):
+        """device_update frame that later delta frames apply on top of"""
+        return EncodedJSON(
+            f'{{"seq":{self.version},"full":true,"devices":{self.devices_json()},"removed":[],'
+            f'"timestamp":{self.timestamp_json},"statistics":{self.statistics_json}}}'
+        )
+    
+    def devices_body(self):
+        """Body of GET /api/devices"""
+        return (f'{{"devices":{self.devices_json()},"statistics":{self.statistics_json},'
+                f'"timestamp":{self.timestamp_json}}}')
+
+current_snapshot = DeviceSnapshot.empty()
+
+def publish_device_update(current_time):
+    """Publish the next snapshot and broadcast only the devices and fields that changed since the last"""
+    global current_snapshot
+    previous = current_snapshot
+    with metrics.timed('serialize'):
+        snapshot = DeviceSnapshot.capture(previous.version + 1, current_time, calculate_statistics())
+        changed, removed = build_device_delta(previous.columns, snapshot.columns, snapshot.live_rows(),
+                                              snapshot.records)
+        frame = delta_frame(snapshot, changed, removed)
+    current_snapshot = snapshot
+    if shared_snapshot_writer is not None:
+        with metrics.timed('share'):
+            shared_snapshot_writer.publish(snapshot, frame)
+    broadcast_device_update(snapshot, frame, changed)
+
+def delta_frame(snapshot, changed, removed):
+    return EncodedJSON(
+        f'{{"seq":{snapshot.version},"full":false,"devices":{json.dumps(changed)},'
+        f'"removed":{json.dumps(removed)},"timestamp":{snapshot.timestamp_json},'
+        f'"statistics":{snapshot.statistics_json}}}'
+    )
+
+def broadcast_device_update(snapshot, frame, changed):
+    """Send each subscription room its frame for this snapshot; the fleet frame is the one given.
+    Clients whose outbound queue is full are skipped, so a slow connection holds at most
+    CLIENT_QUEUE_LIMIT packets; once it drains, the skipped ticks collapse into one full frame."""
+    sent = emitted = dropped = 0
+    with metrics.timed('emit'):
+        for room, clients in device_rooms.frames(snapshot, frame, changed):
+            skipped = []
+            caught_up = []
+            for client in clients:
+                if outbound_queue_depth(client.sid) >= CLIENT_QUEUE_LIMIT:
+                    client.behind = True
+                    client.dropped += 1
+                    skipped.append(client.sid)
+                elif client.behind:
+                    caught_up.append(client)
+                    skipped.append(client.sid)
+                else:
+                    client.sent_seq = snapshot.version
+            dropped += len(skipped) - len(caught_up)
+            if len(skipped) < len(clients):
+                socketio.emit('device_update', room.frame, to=room.name, skip_sid=skipped)
+                sent += 1
+                emitted += len(room.frame) * (len(clients) - len(skipped))
+            if caught_up:
+                full_frame = room.selector.full_frame(snapshot)
+                for client in caught_up:
+                    socketio.emit('device_update', full_frame, to=client.sid)
+                    client.behind = False
+                    client.sent_seq = snapshot.version
+                sent += 1
+                emitted += len(full_frame) * len(caught_up)
+    metrics.count('emitted_frames', sent)
+    metrics.count('emitted_bytes', emitted)
+    if dropped:
+        metrics.count('dropped_frames', dropped)
+
+def outbound_queue_depth(sid):
+    """Packets queued for a Socket.IO client that its transport hasn't written out yet"""
+    server = socketio.server
+    try:
+        return server.eio.sockets[server.manager.eio_sid_from_sid(sid, '/')].queue.qsize()
+    except (KeyError, AttributeError):
+        return 0
+
+FLEET_ROOM = 'fleet'  # clients that haven't subscribed to anything narrower get every device
+
+class DeviceSelector:
+    """What a Socket.IO client watches: devices matching every filter given, or statistics only"""
+    __slots__ = ('location', 'device_type', 'ids', 'statistics_only')
+    
+    def __init__(self, location=None, device_type=None, ids=None, statistics_only=False):
+        self.location = location
+        self.device_type = device_type
+        self.ids = ids  # frozenset of device ids, or None for any
+        self.statistics_only = statistics_only
+    
+    @classmethod
+    def parse(cls, data):
+        """Selector from a 'subscribe' event payload; raises ValueError when it's malformed"""
+        data = data or {}
+        if not isinstance(data, dict):
+            raise ValueError('Subscription must be an object')
+        unknown = set(data) - {'location', 'type', 'ids', 'statistics'}
+        if unknown:
+            raise ValueError(f"Unknown subscription fields: {', '.join(sorted(unknown))}")
+        ids = data.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(device_id, str) for device_id in ids)):
+            raise ValueError('ids must be a list of device ids')
+        if data.get('statistics'):
+            return cls(statistics_only=True)
+        return cls(data.get('location'), data.get('type'), frozenset(ids) if ids is not None else None)
+    
+    @property
+    def room(self):
+        """Socket.IO room shared by every client with an equal selector"""
+        if self.statistics_only:
+            return 'statistics'
+        if self.location is None and self.device_type is None and self.ids is None:
+            return FLEET_ROOM
+        return 'devices:' + json.dumps([self.location, self.device_type,
+                                        sorted(self.ids) if self.ids is not None else None])
+    
+    def members(self, snapshot):
+        """Ids of the snapshot's devices this selector covers"""
+        if self.statistics_only:
+            return frozenset()
+        if self.ids is not None:
+            return frozenset(
+                record.id for record in map(snapshot.find, self.ids)
+                if record is not None
+                and self.location in (None, record.location) and self.device_type in (None, record.type)
+            )
+        return frozenset(snapshot.columns['ids'][snapshot.select_rows(self.location, self.device_type)].tolist())
+    
+    def full_frame(self, snapshot):
+        """device_update frame with every covered device, that this selector's delta frames apply on top of"""
+        if self.room == FLEET_ROOM:
+            return snapshot.full_frame()
+        rows = np.array([snapshot.find(device_id).row for device_id in self.members(snapshot)], dtype=np.int64)
+        devices = devices_data.serialize(rows, snapshot.columns, snapshot.records)
+        return EncodedJSON(
+            f'{{"seq":{snapshot.version},"full":true,"devices":{json.dumps(devices)},"removed":[],'
+            f'"timestamp":{snapshot.timestamp_json},"statistics":{snapshot.statistics_json}}}'
+        )
+
+class DeviceRoom:
+    __slots__ = ('name', 'selector', 'clients', 'members', 'frame')
+    
+    def __init__(self, selector, members):
+        self.name = selector.room
+        self.selector = selector
+        self.clients = {}  # sid -> SocketClient
+        self.members = members  # device ids covered as of the last frame sent
+        self.frame = None
+
+class SocketClient:
+    """Delivery state of one Socket.IO client, for backpressure and the lag it reports"""
+    __slots__ = ('sid', 'room', 'sent_seq', 'dropped', 'behind', 'connected_at')
+    
+    def __init__(self, sid, room, sent_seq):
+        self.sid = sid
+        self.room = room
+        self.sent_seq = sent_seq  # snapshot version of the last frame queued for the client
+        self.dropped = 0  # frames skipped because its outbound queue was full
+        self.behind = False
+        self.connected_at = time.time()
+
+class DeviceRooms:
+    """Socket.IO clients grouped by selector. Each tick builds one frame per room with clients, from the
+    fleet delta: changed fields of devices still covered, whole records of devices that came into the
+    selector (new, or edited into its location or type) and the ids of those that left it."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.clients = {}  # sid -> SocketClient
+    
+    def join(self, sid, selector, snapshot):
+        """Move a client into the selector's room as of a full frame of snapshot; returns the name of
+        the room it leaves, if any"""
+        with self.lock:
+            previous = self._leave(sid)
+            room = self.rooms.get(selector.room)
+            if room is None:
+                room = self.rooms[selector.room] = DeviceRoom(selector, selector.members(snapshot))
+            client = self.clients[sid] = SocketClient(sid, room.name, snapshot.version)
+            if previous is not None:
+                client.dropped = previous.dropped
+                client.connected_at = previous.connected_at
+            room.clients[sid] = client
+            return previous.room if previous is not None else None
+    
+    def leave(self, sid):
+        with self.lock:
+            self._leave(sid)
+    
+    def _leave(self, sid):
+        client = self.clients.pop(sid, None)
+        if client is not None:
+            room = self.rooms[client.room]
+            del room.clients[sid]
+            if not room.clients:
+                del self.rooms[client.room]
+        return client
+    
+    def resynced(self, sid, snapshot):
+        """Selector of a client about to be sent a full frame of snapshot"""
+        with self.lock:
+            client = self.clients.get(sid)
+            if client is None:
+                return DeviceSelector()
+            client.sent_seq = snapshot.version
+            client.behind = False
+            return self.rooms[client.room].selector
+    
+    def stats(self, version):
+        """Per-client room, lag in ticks, queued packets and dropped frames"""
+        with self.lock:
+            clients = list(self.clients.values())
+        return [{
+            'sid': client.sid,
+            'room': client.room,
+            'lag_ticks': version - client.sent_seq,
+            'queued_packets': outbound_queue_depth(client.sid),
+            'dropped_frames': client.dropped,
+            'behind': client.behind,
+            'connected_seconds': int(time.time() - client.connected_at)
+        } for client in clients]
+    
+    def selective(self):
+        """Whether any client watches less than the whole fleet, so frames need the fleet delta"""
+        with self.lock:
+            return any(name != FLEET_ROOM for name in self.rooms)
+    
+    def frames(self, snapshot, fleet_frame, changed):
+        """[(room, clients)] with room.frame set to this snapshot's frame for it"""
+        with self.lock:
+            rooms = [(room, list(room.clients.values())) for room in self.rooms.values()]
+        statistics_frame = None
+        for room, _ in rooms:
+            if room.name == FLEET_ROOM:
+                room.frame = fleet_frame
+            elif room.selector.statistics_only:
+                if statistics_frame is None:
+                    statistics_frame = delta_frame(snapshot, {}, [])
+                room.frame = statistics_frame
+            else:
+                members = room.selector.members(snapshot)
+                entered = members - room.members
+                devices = {device_id: changed[device_id] for device_id in members & changed.keys()
+                           if device_id not in entered}
+                if entered:
+                    rows = np.array([snapshot.find(device_id).row for device_id in entered], dtype=np.int64)
+                    devices.update(devices_data.serialize(rows, snapshot.columns, snapshot.records))
+                room.frame = delta_frame(snapshot, devices, sorted(room.members - members))
+                room.members = members
+        return rooms
+
+device_rooms = DeviceRooms()
+
+class SharedRecord:
+    """Device config as read back from shared memory; stands in for DeviceRecord in web worker snapshots"""
+    __slots__ = DEVICE_CONFIG_FIELDS + ('row',)
+    
+    def __init__(self, config, row):
+        for field in DEVICE_CONFIG_FIELDS:
+            setattr(self, field, config.get(field))
+        self.row = row
+
+class SnapshotRing:
+    """Fixed slots of shared memory that the ingest process writes published snapshots into, round robin.
+    A slot is stamped with its write number once complete; readers keep a copy only if the stamp
+    read before and after copying matches. When a snapshot outgrows the slots the writer moves to a
+    bigger segment and bumps the generation in the small control segment readers watch."""
+    
+    CONTROL = struct.Struct('<8sQ')  # magic, generation
+    HEADER = struct.Struct('<8sIIQQ')  # magic, slot count, unused, slot size, last write number
+    SLOT = struct.Struct('<QQ')  # write number stamped on the slot, payload length
+    MAGIC = b'IOTSNAP1'
+    
+    def __init__(self, name, control, writer):
+        self.name = name
+        self.control = control
+        self.writer = writer
+        self.generation = 0
+        self.segment = None
+        self.slots = self.slot_size = 0
+        self.written = 0
+    
+    @classmethod
+    def create(cls, name, slots=SHARED_RING_SLOTS, slot_size=SHARED_SLOT_BYTES):
+        ring = cls(name, shared_memory.SharedMemory(name=name, create=True, size=cls.CONTROL.size), writer=True)
+        ring._resize(slots, slot_size)
+        return ring
+    
+    @classmethod
+    def attach(cls, name):
+        return cls(name, attach_shared_memory(name), writer=False)
+    
+    def _resize(self, slots, slot_size):
+        previous = self.segment
+        self.generation += 1
+        size = self.HEADER.size + slots * (self.SLOT.size + slot_size)
+        self.segment = shared_memory.SharedMemory(name=f'{self.name}.{self.generation}', create=True, size=size)
+        self.HEADER.pack_into(self.segment.buf, 0, self.MAGIC, slots, 0, slot_size, self.written)
+        self.slots, self.slot_size = slots, slot_size
+        self.CONTROL.pack_into(self.control.buf, 0, self.MAGIC, self.generation)
+        if previous is not None:
+            # Readers still mapping the old segment keep it until they move on; the name goes now
+            previous.close()
+            previous.unlink()
+    
+    def write(self, parts):
+        """Store one payload given as a list of bytes-like parts"""
+        length = sum(len(part) for part in parts)
+        if length > self.slot_size:
+            self._resize(self.slots, 1 << (length + length // 2).bit_length())
+        number = self.written + 1
+        offset = self.HEADER.size + (number % self.slots) * (self.SLOT.size + self.slot_size)
+        buf = self.segment.buf
+        self.SLOT.pack_into(buf, offset, 0, length)
+        position = offset + self.SLOT.size
+        for part in parts:
+            buf[position:position + len(part)] = part
+            position += len(part)
+        self.SLOT.pack_into(buf, offset, number, length)
+        self.written = number
+        struct.pack_into('<Q', buf, self.HEADER.size - 8, number)
+    
+    def read_latest(self, after):
+        """(write number, payload bytes) of the newest complete slot written after `after`, else None"""
+        magic, generation = self.CONTROL.unpack_from(self.control.buf)
+        if magic != self.MAGIC:
+            return None
+        if generation != self.generation:
+            if self.segment is not None:
+                self.segment.close()
+            self.segment = attach_shared_memory(f'{self.name}.{generation}')
+            self.generation = generation
+            _, self.slots, _, self.slot_size, _ = self.HEADER.unpack_from(self.segment.buf)
+        buf = self.segment.buf
+        number = struct.unpack_from('<Q', buf, self.HEADER.size - 8)[0]
+        if number <= after:
+            return None
+        offset = self.HEADER.size + (number % self.slots) * (self.SLOT.size + self.slot_size)
+        stamp, length = self.SLOT.unpack_from(buf, offset)
+        if stamp != number:
+            return None
+        payload = bytes(buf[offset + self.SLOT.size:offset + self.SLOT.size + length])
+        if self.SLOT.unpack_from(buf, offset)[0] != number:
+            return None  # overwritten while copying; the next read picks up the newer slot
+        return number, payload
+    
+    def close(self):
+        for segment in (self.segment, self.control):
+            if segment is not None:
+                segment.close()
+        if self.writer:
+            self.segment.unlink()
+            self.control.unlink()
+
+def attach_shared_memory(name):
+    """Open an existing segment without registering it for cleanup by this process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the name too; run_split's processes share one resource
+        # tracker in which the ingest registered it already, so this changes nothing
+        return shared_memory.SharedMemory(name=name)
+
+class SharedSnapshotWriter:
+    """Encodes each published snapshot into the ring: a JSON header, the raw column arrays, the device
+    configs (re-encoded only when store metadata changes) and the delta frame already sent to clients"""
+    
+    def __init__(self, ring):
+        self.ring = ring
+        self.records_key = None
+        self.records_json = b''
+    
+    def publish(self, snapshot, frame):
+        # Widest types first, so every column starts aligned once the header is padded to 8 bytes
+        columns = sorted(((name, snapshot.columns[name]) for name in DEVICE_COLUMNS),
+                         key=lambda item: -item[1].itemsize)
+        records_key = (len(snapshot.records), int(snapshot.columns['generation'].sum()))
+        if records_key != self.records_key:
+            self.records_json = json.dumps([
+                record.config() if record is not None else None for record in snapshot.records
+            ]).encode()
+            self.records_key = records_key
+        frame = frame.encode()
+        header = json.dumps({
+            'version': snapshot.version,
+            'timestamp': snapshot.timestamp,
+            'modified': snapshot.modified,
+            'statistics': snapshot.statistics,
+            'settings': settings,
+            'settings_version': settings_version,
+            'settings_modified': settings_modified,
+            'instance': SERVER_INSTANCE,
+            'records_key': records_key,
+            'columns': [(name, column.dtype.str, column.nbytes) for name, column in columns],
+            'records_bytes': len(self.records_json),
+            'frame_bytes': len(frame)
+        }).encode()
+        header += b' ' * (-(len(header) + 4) % 8)
+        self.ring.write([struct.pack('<I', len(header)), header, *(column.view(np.uint8) for _, column in columns),
+                         self.records_json, frame])
+
+class SharedSnapshotReader:
+    """Rebuilds DeviceSnapshots from the ring in a web worker"""
+    
+    def __init__(self, ring):
+        self.ring = ring
+        self.number = 0
+        self.records_key = None
+        self.records = []
+        self.ids = np.empty(0, dtype=object)
+        self.index = None
+        self.secondary_indexes = None
+    
+    def read(self):
+        """(snapshot, delta frame, header) for the newest slot not yet read, else None"""
+        latest = self.ring.read_latest(self.number)
+        if latest is None:
+            return None
+        self.number, payload = latest
+        header_length = struct.unpack_from('<I', payload)[0]
+        position = 4 + header_length
+        header = json.loads(payload[4:position])
+        columns = {}
+        for name, dtype, nbytes in header['columns']:
+            columns[name] = np.frombuffer(payload, dtype=dtype, count=nbytes // np.dtype(dtype).itemsize, offset=position)
+            position += nbytes
+        if header['records_key'] != self.records_key:
+            configs = json.loads(payload[position:position + header['records_bytes']])
+            self.records = [SharedRecord(config, row) if config is not None else None
+                            for row, config in enumerate(configs)]
+            self.ids = np.array([record.id if record is not None else None for record in self.records], dtype=object)
+            self.records_key = header['records_key']
+            self.index = self.secondary_indexes = None
+        position += header['records_bytes']
+        columns['ids'] = self.ids
+        frame = EncodedJSON(payload[position:position + header['frame_bytes']].decode())
+        snapshot = DeviceSnapshot(header['version'], header['timestamp'], header['modified'], columns,
+                                  self.records, header['statistics'], self.secondary_indexes)
+        if self.index is not None:
+            snapshot._index = self.index
+        else:
+            self.index = snapshot.index()
+            self.secondary_indexes = snapshot.secondary_indexes()
+        return snapshot, frame, header
+
+shared_snapshot_writer = None  # set in the ingest process of a split deployment
+shared_snapshot_reader = None  # set in web worker processes
+shared_snapshot_lock = threading.Lock()
+shared_snapshots_stopping = threading.Event()
+
+def refresh_shared_snapshot():
+    """Take the newest snapshot the ingest process published, and broadcast what changed"""
+    global current_snapshot, settings_version, settings_modified, SERVER_INSTANCE
+    with shared_snapshot_lock:
+        update = shared_snapshot_reader.read()
+        if update is None:
+            return False
+        snapshot, frame, header = update
+        previous = current_snapshot
+        skipped = snapshot.version != previous.version + 1
+        changed = {}
+        if skipped or device_rooms.selective():
+            changed, removed = build_device_delta(previous.columns, snapshot.columns, snapshot.live_rows(),
+                                                  snapshot.records)
+        if skipped:
+            # Slots were skipped, so the ingest's delta doesn't apply to what our clients hold
+            frame = delta_frame(snapshot, changed, removed)
+        # Validators come from the ingest, so an ETag from one worker is good at any other
+        SERVER_INSTANCE = header['instance']
+        if header['settings_version'] != settings_version:
+            settings.update(header['settings'])
+            settings_version = header['settings_version']
+            settings_modified = header['settings_modified']
+        current_snapshot = snapshot
+        # Under the lock too: room frames are deltas against the previous broadcast
+        broadcast_device_update(snapshot, frame, changed)
+    return True
+
+def follow_shared_snapshots():
+    """Web worker thread: pick up snapshots from the ingest process as they are published"""
+    while not shared_snapshots_stopping.is_set():
+        try:
+            if not refresh_shared_snapshot():
+                shared_snapshots_stopping.wait(SHARED_POLL_INTERVAL)
+        except Exception as e:
+            print(f"Error reading shared snapshot: {e}")
+            shared_snapshots_stopping.wait(1)
+
+def run_in_update_loop(command, *args):
+    """Have the update loop apply a state change and wait for its result (exceptions re-raise here)"""
+    future = Future()
+    update_commands.put((future, command, args))
+    return future.result(timeout=UPDATE_COMMAND_TIMEOUT)
+
+def apply_update_commands(deadline):
+    """Apply queued API commands until the next tick is due, publishing a snapshot after each batch.
+    Commands already queued are applied even when the tick is overdue, so writes still go through
+    while ticks keep overrunning; the deadline only bounds waiting for more."""
+    drained = False
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                batch = [update_commands.get(timeout=remaining)]
+            elif not drained:
+                batch = [update_commands.get_nowait()]
+            else:
+                return
+        except queue.Empty:
+            return
+        drained = True
+        while True:
+            try:
+                batch.append(update_commands.get_nowait())
+            except queue.Empty:
+                break
+        
+        outcomes = []
+        for future, command, args in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                outcomes.append((future, command(*args), None))
+            except Exception as e:
+                outcomes.append((future, None, e))
+        
+        # Publish before answering, so a client reading right after its response sees the change
+        try:
+            publish_device_update(datetime.now())
+        except Exception as e:
+            print(f"Error publishing device update: {e}")
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
 def get_next_device_id():
     """Get next available device ID"""
@@ -211,8 +1571,6 @@ def get_next_device_id():
 
 def initialize_devices():
     """Initialize devices - load from DB or create default 100 devices"""
-    global devices_data
-    
     # Load existing devices from database
     load_devices_from_db()
     
@@ -232,30 +1590,11 @@ def initialize_devices():
                     'ip_address': REAL_DEVICE_CONFIG['address'],
                     'tuya_device_id': REAL_DEVICE_CONFIG['dev_id'],
                     'local_key': REAL_DEVICE_CONFIG['local_key'],
+                    'tuya_version': REAL_DEVICE_CONFIG['version'],
                     'is_real': True
                 }
                 
-                devices_data[device_id] = {
-                    'id': device_id,
-                    'name': device_data['name'],
-                    'type': device_data['type'],
-                    'location': device_data['location'],
-                    'ip_address': device_data['ip_address'],
-                    'tuya_device_id': device_data['tuya_device_id'],
-                    'local_key': device_data['local_key'],
-                    'status': 'online',
-                    'state': False,
-                    'voltage': 220.0,
-                    'current': 0.0,
-                    'power': 0.0,
-                    'energy': 0.0,
-                    'temperature': 25.0,
-                    'humidity': 60.0,
-                    'last_updated': datetime.now(),
-                    'is_real': True,
-                    'cost_today': 0.0,
-                    'uptime': 0
-                }
+                devices_data.add(device_data, status='online', voltage=220.0)
                 save_device_to_db(device_data)
                 
             else:  # Simulated devices
@@ -270,220 +1609,1411 @@ def initialize_devices():
                     'is_real': False
                 }
                 
-                devices_data[device_id] = {
-                    'id': device_id,
-                    'name': device_data['name'],
-                    'type': device_data['type'],
-                    'location': device_data['location'],
-                    'ip_address': None,
-                    'tuya_device_id': None,
-                    'local_key': None,
-                    'status': random.choice(['online', 'online', 'online', 'offline']),
-                    'state': random.choice([True, False]),
-                    'voltage': round(random.uniform(210, 230), 1),
-                    'current': round(random.uniform(0.001, 0.5), 3),
-                    'power': round(random.uniform(10, 1500), 1),
-                    'energy': round(random.uniform(0, 100), 3),
-                    'temperature': round(random.uniform(20, 35), 1),
-                    'humidity': round(random.uniform(40, 80), 1),
-                    'last_updated': datetime.now(),
-                    'is_real': False,
-                    'cost_today': round(random.uniform(0, 50), 2),
-                    'uptime': random.randint(0, 86400)
-                }
+                devices_data.add(
+                    device_data,
+                    status=random.choice(['online', 'online', 'online', 'offline']),
+                    state=random.choice([True, False]),
+                    voltage=round(random.uniform(210, 230), 1),
+                    current=round(random.uniform(0.001, 0.5), 3),
+                    power=round(random.uniform(10, 1500), 1),
+                    energy=round(random.uniform(0, 100), 3),
+                    temperature=round(random.uniform(20, 35), 1),
+                    humidity=round(random.uniform(40, 80), 1),
+                    cost_today=round(random.uniform(0, 50), 2),
+                    uptime=random.randint(0, 86400)
+                )
                 save_device_to_db(device_data)
     
-    print(f"✓ Initialized {len(devices_data)} devices")
+    fleet_stats.rebuild()
+    print(f"✓ Initialized {len(devices_data)} devices")
+
+def parse_tuya_status(data):
+    """Convert a Tuya status() reply into device telemetry fields"""
+    if 'dps' in data:
+        dps = data['dps']
+        return {
+            'status': 'online',
+            'state': dps.get('1', False),
+            'voltage': dps.get('20', 2200) / 10.0,
+            'current': dps.get('18', 0) / 1000.0,
+            'power': dps.get('19', 0) / 10.0,
+            'energy': dps.get('17', 0) / 1000.0
+        }
+    return {'status': 'offline'}
+
+def tuya_connection_params(device):
+    return (device.tuya_device_id, device.ip_address, device.local_key,
+            device.tuya_version or REAL_DEVICE_CONFIG['version'])
+
+def is_pollable(device):
+    """Check whether a device has enough configuration to be polled over the LAN"""
+    return bool(device.is_real and device.tuya_device_id and device.local_key and device.ip_address)
+
+class TuyaConnection:
+    """Persistent LAN session with one Tuya device over asyncio streams. The tinytuya device
+    object never opens a socket here; it only builds, encrypts and decodes messages.
+    Once open, listen() reads every frame: replies complete the request waiting on that
+    command, and any status the device includes or pushes on its own goes to on_status."""
+    
+    def __init__(self, dev_id, address, local_key, version):
+        self.address = address
+        self.codec = tinytuya.OutletDevice(dev_id=dev_id, address=address, local_key=local_key, version=version)
+        self.reader = None
+        self.writer = None
+        self.waiting = {}  # reply command -> Future for the request expecting it
+        self.last_received = 0.0  # event loop time of the last frame from the device
+    
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.address, TUYA_PORT)
+        if self.codec.version >= 3.4:
+            await self.send(self.codec._negotiate_session_key_generate_step_1())
+            step_3 = self.codec._negotiate_session_key_generate_step_3(await self.receive())
+            if not step_3:
+                raise ConnectionError('Session key negotiation failed (wrong local key or version?)')
+            await self.send(step_3)
+            self.codec._negotiate_session_key_generate_finalize()
+        self.last_received = asyncio.get_running_loop().time()
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        for waiter in self.waiting.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError('Connection closed'))
+        self.waiting.clear()
+    
+    async def send(self, payload):
+        self.writer.write(self.codec._encode_message(payload))
+        await self.writer.drain()
+    
+    async def receive(self):
+        """Read one framed message, skipping bytes until a 55AA/6699 prefix"""
+        data = await self.reader.readexactly(4)
+        while data not in (tinytuya.PREFIX_55AA_BIN, tinytuya.PREFIX_6699_BIN):
+            data = data[1:] + await self.reader.readexactly(1)
+        header_format = (tinytuya.MESSAGE_HEADER_FMT_6699 if data == tinytuya.PREFIX_6699_BIN
+                         else tinytuya.MESSAGE_HEADER_FMT_55AA)
+        data += await self.reader.readexactly(struct.calcsize(header_format) - 4)
+        header = tinytuya.parse_header(data)
+        data += await self.reader.readexactly(header.total_length - len(data))
+        hmac_key = self.codec.local_key if self.codec.version >= 3.4 else None
+        return tinytuya.unpack_message(data, hmac_key=hmac_key, header=header)
+    
+    async def listen(self, on_status):
+        """Route incoming frames until the device closes the connection"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                message = await self.receive()
+            except asyncio.IncompleteReadError:
+                raise ConnectionError('Connection closed by device')
+            self.last_received = loop.time()
+            result = self.codec._decode_payload(message.payload) if message.payload else {}
+            waiter = self.waiting.pop(message.cmd, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(result)
+            if result and 'dps' in result:
+                on_status(result['dps'])
+    
+    async def request(self, command, data=None):
+        """Send a command and wait for the device's reply to it (listen() must be running)"""
+        for _ in range(2):  # a second try after the codec switches to the device22 dialect
+            payload = self.codec.generate_payload(command, data)
+            reply = asyncio.get_running_loop().create_future()
+            self.waiting[payload.cmd] = reply
+            try:
+                await self.send(payload)
+                result = await reply
+            finally:
+                if self.waiting.get(payload.cmd) is reply:
+                    del self.waiting[payload.cmd]
+            if result is not None:
+                return result
+        return None
+    
+    async def status(self):
+        return await self.request(tinytuya.DP_QUERY)
+    
+    async def heartbeat(self):
+        return await self.request(tinytuya.HEART_BEAT)
+    
+    async def set_status(self, on, switch=1):
+        return await self.request(tinytuya.CONTROL, {str(switch): on})
+
+class DeviceSession:
+    """The one task that talks to a real device. It keeps a connection open, takes the status
+    the device pushes, sends heartbeats while the line is quiet and queries status itself only
+    when no data has arrived for a poll period. Commands share the lock with those requests.
+    A lost connection is retried with exponential backoff behind a circuit breaker."""
+    
+    def __init__(self, device_io, device_id, params, period):
+        self.device_io = device_io
+        self.device_id = device_id
+        self.params = params
+        self.period = period
+        self.lock = asyncio.Lock()
+        self.stopped = False
+        self.connection = TuyaConnection(*params)
+        self.dps = {}  # last known value of every data point, merged from replies and pushes
+        self.last_data = 0.0  # event loop time of the last status from the device
+        self.failures = 0  # connection attempts in a row that ended without any status
+        self.retry_at = 0.0  # epoch seconds of the next attempt while backing off
+        self.commanded = None  # state last switched to by control(), until the device confirms it
+        self.task = asyncio.get_running_loop().create_task(self.run())
+    
+    @property
+    def circuit(self):
+        return 'open' if self.failures >= DEVICE_CIRCUIT_THRESHOLD else 'closed'
+    
+    def health(self, circuit=None):
+        return {'circuit': circuit or self.circuit, 'failures': self.failures, 'retry_at': self.retry_at}
+    
+    def backoff(self):
+        """Seconds until the next attempt: the poll period doubled per failure, with jitter"""
+        delay = min(DEVICE_BACKOFF_MAX, max(self.period, 1.0) * 2 ** min(self.failures - 1, 16))
+        return delay * random.uniform(0.8, 1.0)
+    
+    async def run(self):
+        try:
+            while not self.stopped:
+                if self.circuit == 'open':
+                    # Background probe: a single connection attempt while the device stays marked unreachable
+                    self.retry_at = 0.0
+                    self.device_io.publish(self.device_id, dict({'status': 'offline'}, **self.health('half_open')))
+                try:
+                    await asyncio.wait_for(self.connection.open(), POLL_DEADLINE)
+                    await self.keep_alive()
+                except Exception as e:
+                    if not self.failures:
+                        print(f"Error getting real device data for {self.device_id}: {e!r}")
+                self.connection.close()
+                self.dps.clear()
+                self.last_data = 0.0
+                if self.stopped:
+                    break
+                self.failures += 1
+                if self.failures == DEVICE_CIRCUIT_THRESHOLD:
+                    print(f"Circuit open for {self.device_id} after {self.failures} failed attempts; probing in the background")
+                delay = self.backoff()
+                self.retry_at = time.time() + delay
+                self.device_io.publish(self.device_id, dict({'status': 'offline'}, **self.health()))
+                await asyncio.sleep(delay)
+        finally:
+            self.connection.close()
+    
+    async def keep_alive(self):
+        """Serve an open connection until it fails"""
+        loop = asyncio.get_running_loop()
+        listener = loop.create_task(self.connection.listen(self.on_status))
+        try:
+            while not listener.done():
+                now = loop.time()
+                if now - self.last_data >= self.period:
+                    reply = await self.send_request(self.connection.status)
+                    if reply is None or 'dps' not in reply:
+                        raise ConnectionError((reply or {}).get('Error', 'No status in reply'))
+                elif now - self.connection.last_received >= HEARTBEAT_INTERVAL:
+                    await self.send_request(self.connection.heartbeat)
+                wake = min(self.last_data + self.period, self.connection.last_received + HEARTBEAT_INTERVAL)
+                await asyncio.wait({listener}, timeout=max(0.0, wake - loop.time()))
+            listener.result()
+        finally:
+            listener.cancel()
+    
+    async def send_request(self, method, *args):
+        async with self.lock:
+            return await asyncio.wait_for(method(*args), POLL_DEADLINE)
+    
+    def on_status(self, dps):
+        if self.failures >= DEVICE_CIRCUIT_THRESHOLD:
+            print(f"Device {self.device_id} is reachable again; circuit closed")
+        self.failures = 0
+        self.retry_at = 0.0
+        state = self.dps.get('1')
+        self.dps.update(dps)
+        self.last_data = asyncio.get_running_loop().time()
+        self.device_io.publish(self.device_id, dict(parse_tuya_status({'dps': self.dps}), **self.health()))
+        if '1' in dps and dps['1'] == self.commanded:
+            self.commanded = None  # our own command echoed back; the API already applied it
+        elif '1' in dps and dps['1'] != state and state is not None:
+            # Switched at the device or by another app: show it now rather than on the next tick
+            self.device_io.post_state(self.device_id, dps['1'])
+    
+    async def control(self, on):
+        if self.connection.writer is None:
+            if self.retry_at:
+                condition = 'unreachable' if self.circuit == 'open' else 'reconnecting'
+                raise ConnectionError(f'Device is {condition}; next retry in {max(0, self.retry_at - time.time()):.0f}s')
+            raise ConnectionError('Device is not connected')
+        self.commanded = on
+        reply = await self.send_request(self.connection.set_status, on)
+        if reply is not None and 'Error' in reply:
+            raise ConnectionError(reply['Error'])
+        return reply
+    
+    def stop(self):
+        # wait_for() can swallow a cancel that lands as the reply arrives; the flag ends the loop anyway
+        self.stopped = True
+        self.task.cancel()
+
+class DeviceIO:
+    """Event loop thread owning every real device connection, one DeviceSession task per device.
+    Readings are collected as they arrive and handed to the update loop once per tick."""
+    
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.sessions = {}  # device_id -> DeviceSession, touched only on the event loop
+        self.readings = {}
+        self.readings_lock = threading.Lock()
+    
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='device-io', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        if self.thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop_sessions(), self.loop).result(timeout=POLL_DEADLINE + 1)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+    
+    async def _stop_sessions(self):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            session.stop()
+        await asyncio.gather(*(session.task for session in sessions), return_exceptions=True)
+    
+    def publish(self, device_id, reading):
+        with self.readings_lock:
+            self.readings[device_id] = reading
+    
+    def post_state(self, device_id, state):
+        """Hand a pushed on/off change to the update loop without waiting for its result"""
+        update_commands.put((Future(), set_device_state, (device_id, state)))
+    
+    def take_readings(self):
+        """Latest reading per device since the previous call"""
+        with self.readings_lock:
+            readings, self.readings = self.readings, {}
+        return readings
+    
+    def sync(self, devices):
+        """Match the running sessions to {device_id: (connection params, period)} without waiting"""
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self._sync, devices)
+    
+    def _sync(self, devices):
+        for device_id in list(self.sessions):
+            session = self.sessions[device_id]
+            wanted = devices.get(device_id)
+            if wanted is None or wanted[0] != session.params:
+                session.stop()
+                del self.sessions[device_id]
+            else:
+                session.period = wanted[1]
+        for device_id, (params, period) in devices.items():
+            if device_id not in self.sessions:
+                self.sessions[device_id] = DeviceSession(self, device_id, params, period)
+    
+    async def _control(self, device_id, params, on):
+        session = self.sessions.get(device_id)
+        if session is None or session.params != params:
+            raise ConnectionError('Device is not connected')
+        # Queued behind at most one request in progress, each with POLL_DEADLINE to answer
+        try:
+            return await asyncio.wait_for(session.control(on), 2 * POLL_DEADLINE)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Device did not answer within {2 * POLL_DEADLINE:g}s') from None
+    
+    def control(self, device_id, params, on):
+        """Switch a device from another thread, queued behind any request in progress; returns the reply.
+        Raises ConnectionError when the device is unreachable and TimeoutError when it doesn't answer."""
+        future = asyncio.run_coroutine_threadsafe(self._control(device_id, params, on), self.loop)
+        try:
+            return future.result(timeout=2 * POLL_DEADLINE + 1)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f'Device did not answer within {2 * POLL_DEADLINE:g}s') from None
+    
+    def control_many(self, devices, on):
+        """Switch {device_id: connection params} concurrently; returns {device_id: reply or exception},
+        a slow device counting as a TimeoutError of its own without holding up the others' results"""
+        async def run():
+            replies = await asyncio.gather(*(self._control(device_id, params, on)
+                                             for device_id, params in devices.items()), return_exceptions=True)
+            return dict(zip(devices, replies))
+        future = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        try:
+            return future.result(timeout=2 * POLL_DEADLINE + 1)
+        except FutureTimeoutError:
+            future.cancel()
+            timeout = TimeoutError(f'Device did not answer within {2 * POLL_DEADLINE:g}s')
+            return dict.fromkeys(devices, timeout)
+
+device_io = DeviceIO()
+
+def poll_real_devices():
+    """Point the device I/O loop at the current real devices and return readings taken since the last tick"""
+    with devices_data.lock:
+        columns = devices_data.columns
+        rows = np.flatnonzero(columns['alive'][:devices_data.size] & columns['is_real'][:devices_data.size])
+        periods = np.maximum(columns['poll_every'][rows], settings['update_interval']).tolist()
+        records = [devices_data.records[row] for row in rows.tolist()]
+    device_io.sync({
+        device.id: (tuya_connection_params(device), period)
+        for device, period in zip(records, periods) if is_pollable(device)
+    })
+    return device_io.take_readings()
+
+def count_unreachable_devices():
+    """Real devices whose circuit is open or being probed"""
+    with devices_data.lock:
+        columns = devices_data.columns
+        size = devices_data.size
+        return int(np.count_nonzero(columns['alive'][:size] & (columns['circuit'][:size] != 0)))
+
+# Simulated device engine
+# Power draw range (W) per device type while switched on; unknown types draw a flat 50 W
+SIM_POWER_RANGES = {
+    'Smart Plug': (10, 100),
+    'Smart Switch': (5, 50),
+    'Smart Bulb': (8, 25),
+    'Smart Fan': (50, 120),
+    'Smart AC': (800, 2000)
+}
+SIM_TYPE_CODES = {device_type: code for code, device_type in enumerate(SIM_POWER_RANGES)}
+SIM_UNKNOWN_TYPE = len(SIM_TYPE_CODES)
+SIM_POWER_LOW = np.array([low for low, _ in SIM_POWER_RANGES.values()] + [50], dtype=np.float64)
+SIM_POWER_HIGH = np.array([high for _, high in SIM_POWER_RANGES.values()] + [50], dtype=np.float64)
+
+class SimulatedFleet:
+    """Advances every simulated device in the store's telemetry columns with vectorized draws"""
+    
+    def __init__(self, store):
+        self.store = store
+        self.rng = np.random.default_rng()
+    
+    def tick(self, elapsed, electricity_rate, current_time):
+        """Sample the online simulated devices that are due; elapsed is seconds since the last tick.
+        Returns the rows that were sampled."""
+        store = self.store
+        now = time.monotonic()
+        with store.lock:
+            n = store.size
+            columns = store.columns
+            online, state, voltage = columns['online'], columns['state'], columns['voltage']
+            current, power, energy = columns['current'], columns['power'], columns['energy']
+            poll_every, next_poll = columns['poll_every'], columns['next_poll']
+            # Half a tick of slack so a device due "about now" isn't pushed to the next tick
+            due = next_poll[:n] <= now + elapsed / 2
+            rows = np.flatnonzero(online[:n] & columns['alive'][:n] & ~columns['is_real'][:n] & due)
+            on = state[rows]
+            on_rows = rows[on]
+            off_rows = rows[~on]
+            
+            # Device is ON - draw around a per-type base power
+            codes = columns['type_code'][on_rows]
+            low = SIM_POWER_LOW[codes]
+            base_power = low + (SIM_POWER_HIGH[codes] - low) * self.rng.random(len(on_rows))
+            power[on_rows] = base_power * self.rng.uniform(0.9, 1.1, len(on_rows))
+            voltage[on_rows] = np.clip(voltage[on_rows] + self.rng.uniform(-1, 1, len(on_rows)), 200, 240)
+            current[on_rows] = power[on_rows] / voltage[on_rows]
+            
+            # Device is OFF - standby power
+            current[off_rows] = self.rng.uniform(0.001, 0.005, len(off_rows))
+            power[off_rows] = voltage[off_rows] * current[off_rows]
+            
+            # Each sample stands for the time since the device's previous one
+            period = np.maximum(poll_every[rows], elapsed)
+            energy[rows] += power[rows] * period / 3600000  # Convert to kWh
+            columns['cost_today'][rows] = np.round(energy[rows] * electricity_rate, 2)
+            columns['uptime'][rows] += np.rint(period).astype(np.int64)
+            columns['last_updated'][rows] = current_time.timestamp()
+            next_poll[rows] = now + poll_every[rows]
+            
+            # Randomly change device status occasionally (0.1% chance per update)
+            flipped = rows[self.rng.random(len(rows)) < 0.001]
+            online[flipped] = self.rng.random(len(flipped)) < 0.5
+            return rows
+
+sim_fleet = SimulatedFleet(devices_data)
+
+def update_tick(current_time, elapsed=None):
+    """One pass of the update loop: poll, simulate, log, persist and publish.
+    elapsed is the time this tick covers, normally the update interval."""
+    if elapsed is None:
+        elapsed = settings['update_interval']
+    # Update real devices
+    with metrics.timed('poll'):
+        readings = poll_real_devices()
+        for device_id, real_data in readings.items():
+            device = devices_data.get(device_id)
+            if device is None:
+                continue
+            if real_data['status'] == 'online':
+                device.status = 'online'
+                device.state = real_data['state']
+                device.voltage = real_data['voltage']
+                device.current = real_data['current']
+                device.power = real_data['power']
+                device.energy = real_data['energy']
+                device.uptime = int((current_time - device_start_time).total_seconds())
+                device.cost_today = round(device.energy * settings['electricity_rate'], 2)
+                device.last_updated = current_time
+            else:
+                device.status = 'offline'
+                metrics.count('poll_failures')
+            device.circuit = real_data['circuit']
+            device.failures = real_data['failures']
+            device.retry_at = real_data['retry_at']
+            fleet_stats.update(device)
+    
+    # Update simulated devices with more realistic behavior
+    with metrics.timed('simulate'):
+        sim_rows = sim_fleet.tick(elapsed, settings['electricity_rate'], current_time)
+        fleet_stats.update_rows(sim_rows)
+    
+    # Log data and emit updates
+    with metrics.timed('csv'):
+        log_data_to_csv(current_time)
+    with metrics.timed('db'):
+        save_historical_data_to_db()
+    
+    try:
+        publish_device_update(current_time)
+    except Exception as emit_error:
+        print(f"Error emitting WebSocket data: {emit_error}")
+
+def update_devices():
+    """Run the update tick on fixed slots of the monotonic clock, however long each tick takes"""
+    slot = time.monotonic()  # when the coming tick is due
+    previous_slot = None
+    while True:
+        interval = settings['update_interval']
+        metrics.last_tick_lag = max(0.0, time.monotonic() - slot)
+        metrics.tick_lag.observe(metrics.last_tick_lag)
+        elapsed = interval if previous_slot is None else slot - previous_slot
+        try:
+            with metrics.timed('tick'):
+                update_tick(datetime.now(), elapsed)
+        except Exception as e:
+            print(f"Error in update_devices: {e}")
+        
+        previous_slot = slot
+        slot += interval
+        behind = time.monotonic() - slot
+        if behind >= 0:
+            # Overran: one or more slots started while this tick was still running
+            missed = int(behind // interval) + 1
+            latest = slot + (missed - 1) * interval
+            metrics.count('tick_overruns')
+            if TICK_OVERRUN_POLICY == 'coalesce':
+                metrics.count('ticks_skipped', missed - 1)
+                slot = latest
+            else:
+                metrics.count('ticks_skipped', missed)
+                slot = latest + interval
+        
+        apply_update_commands(slot)
+
+class FleetStatistics:
+    """Fleet aggregates kept up to date from per-device changes, overall and per location/type"""
+    
+    # Columns of each device's contribution, indexed by device store row
+    DEVICES, ONLINE, ACTIVE, POWER, COST = range(5)
+    REBUILD_INTERVAL = 3600  # seconds between full re-sums that clear floating point drift
+    
+    def __init__(self, store, capacity=1024):
+        self.store = store
+        self.lock = threading.Lock()
+        self.contrib = np.zeros((capacity, 5))
+        self.codes = {'location': np.zeros(capacity, dtype=np.int64), 'type': np.zeros(capacity, dtype=np.int64)}
+        self.group_names = {'location': [], 'type': []}
+        self.group_index = {'location': {}, 'type': {}}
+        self.group_totals = {'location': np.zeros((8, 5)), 'type': np.zeros((8, 5))}
+        self.totals = np.zeros(5)
+        self.last_rebuild = time.monotonic()
+    
+    def group_code(self, group, name):
+        code = self.group_index[group].get(name)
+        if code is None:
+            code = len(self.group_names[group])
+            self.group_index[group][name] = code
+            self.group_names[group].append(name)
+            totals = self.group_totals[group]
+            if code >= len(totals):
+                self.group_totals[group] = np.vstack([totals, np.zeros_like(totals)])
+        return code
+    
+    def ensure_capacity(self, rows):
+        while rows > len(self.contrib):
+            self.contrib = np.vstack([self.contrib, np.zeros_like(self.contrib)])
+            for group, codes in self.codes.items():
+                self.codes[group] = np.concatenate([codes, np.zeros_like(codes)])
+    
+    def _apply(self, row, values):
+        """Replace one row's contribution, taking it out of its old groups"""
+        self.totals += values - self.contrib[row]
+        for group in self.codes:
+            self.group_totals[group][self.codes[group][row]] -= self.contrib[row]
+        self.contrib[row] = values
+    
+    def update(self, device):
+        """Account for the current state and groups of one device"""
+        online = device.status == 'online'
+        values = np.array([
+            1.0, online, online and device.state,
+            device.power if online else 0.0, device.cost_today
+        ])
+        with self.lock:
+            self.ensure_capacity(device.row + 1)
+            self._apply(device.row, values)
+            for group in ('location', 'type'):
+                code = self.group_code(group, getattr(device, group))
+                self.codes[group][device.row] = code
+                self.group_totals[group][code] += values
+    
+    def update_rows(self, rows):
+        """Vectorized update from the store columns for rows whose groups did not change"""
+        if not len(rows):
+            return
+        columns = self.store.columns
+        with self.store.lock:
+            online = columns['online'][rows]
+            values = np.column_stack([
+                columns['alive'][rows], online, online & columns['state'][rows],
+                np.where(online, columns['power'][rows], 0.0), columns['cost_today'][rows]
+            ])
+        # Rows freed while their tick was in flight contribute nothing
+        values[~values[:, self.DEVICES].astype(bool)] = 0.0
+        with self.lock:
+            self.ensure_capacity(rows.max() + 1)
+            delta = values - self.contrib[rows]
+            self.contrib[rows] = values
+            self.totals += delta.sum(axis=0)
+            for group, codes in self.codes.items():
+                np.add.at(self.group_totals[group], codes[rows], delta)
+            if time.monotonic() - self.last_rebuild >= self.REBUILD_INTERVAL:
+                self._resum()
+    
+    def remove(self, device):
+        with self.lock:
+            self.ensure_capacity(device.row + 1)
+            self._apply(device.row, np.zeros(5))
+    
+    def rebuild(self):
+        """Recompute everything from the store"""
+        for device in self.store.values():
+            self.update(device)
+        with self.lock:
+            self._resum()
+    
+    def _resum(self):
+        self.totals = self.contrib.sum(axis=0)
+        for group, codes in self.codes.items():
+            totals = np.zeros_like(self.group_totals[group])
+            np.add.at(totals, codes, self.contrib)
+            self.group_totals[group] = totals
+        self.last_rebuild = time.monotonic()
+    
+    @staticmethod
+    def format(values):
+        devices = int(round(values[FleetStatistics.DEVICES]))
+        online = int(round(values[FleetStatistics.ONLINE]))
+        return {
+            'total_devices': devices,
+            'online_devices': online,
+            'offline_devices': devices - online,
+            'active_devices': int(round(values[FleetStatistics.ACTIVE])),
+            'total_power': round(float(values[FleetStatistics.POWER]), 2),
+            'total_cost': round(float(values[FleetStatistics.COST]), 2)
+        }
+    
+    def summary(self):
+        with self.lock:
+            return self.format(self.totals)
+    
+    def breakdown(self, group):
+        """Aggregates per location or type, for groups that currently have devices"""
+        with self.lock:
+            totals = self.group_totals[group]
+            return {
+                name: self.format(totals[code])
+                for code, name in enumerate(self.group_names[group])
+                if totals[code][self.DEVICES] > 0.5
+            }
+
+fleet_stats = FleetStatistics(devices_data)
+
+def calculate_statistics():
+    """Calculate dashboard statistics"""
+    statistics = fleet_stats.summary()
+    statistics['by_location'] = fleet_stats.breakdown('location')
+    statistics['by_type'] = fleet_stats.breakdown('type')
+    return statistics
+
+class CsvLogWriter:
+    """Keeps one buffered CSV log open, rotating by hour or size and gzipping closed files in the background"""
+    
+    FIELDNAMES = ['timestamp', 'device_id', 'name', 'status', 'state', 'voltage', 'current', 'power', 'energy', 'cost']
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.handle = None
+        self.path = None
+        self.hour = None
+        self.bytes_written = 0
+        self.compressing = set()  # closed paths queued for compression
+        self.stopping = threading.Event()
+        self.flush_thread = None
+        self.compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='csv-compress')
+    
+    def start(self):
+        self.flush_thread = threading.Thread(target=self.flush_periodically, name='csv-flush', daemon=True)
+        self.flush_thread.start()
+    
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            self.close()
+        self.compressor.shutdown(wait=True)
+    
+    def flush_periodically(self):
+        while not self.stopping.wait(settings['csv_flush_interval']):
+            try:
+                with self.lock:
+                    if self.handle:
+                        self.handle.flush()
+            except Exception as e:
+                print(f"Error flushing CSV log: {e}")
+    
+    def open(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        # A log closed earlier (e.g. before a restart within the same hour) is never reopened: its
+        # archive would be overwritten, or the compressor would remove the file while it's written
+        path = os.path.join(self.directory, f'iot_data_{name}.csv')
+        suffix = 0
+        while path in self.compressing or os.path.exists(f'{path}.gz'):
+            suffix += 1
+            path = os.path.join(self.directory, f'iot_data_{name}_{suffix}.csv')
+        self.path = path
+        self.handle = open(self.path, 'ab', buffering=CSV_BUFFER_SIZE)
+        # Only stat once per file; after that the size is tracked in memory
+        self.bytes_written = self.handle.tell()
+        if self.bytes_written == 0:
+            self.write(','.join(self.FIELDNAMES) + '\r\n')
+    
+    def close(self):
+        """Close the current file and queue it for compression"""
+        if self.handle is None:
+            return
+        self.handle.close()
+        path = self.path
+        self.compressing.add(path)
+        self.compressor.submit(compress_csv_log, path).add_done_callback(lambda _: self.compressing.discard(path))
+        self.handle = None
+    
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.handle.write(data)
+        self.bytes_written += len(data)
+    
+    def write_tick(self, current_time, rows):
+        """Append one tick of (device_id, name, status, state, voltage, current, power, energy, cost) rows"""
+        timestamp = current_time.isoformat()
+        hour = current_time.strftime('%Y%m%d_%H')
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows((timestamp, *row) for row in rows)
+        
+        with self.lock:
+            if hour != self.hour:
+                self.close()
+                self.hour = hour
+                self.open(hour)
+            elif self.bytes_written >= settings['file_size_limit'] * 1024 * 1024:
+                self.close()
+                self.open(current_time.strftime('%Y%m%d_%H%M%S'))
+            self.write(buffer.getvalue())
 
-def get_real_device_data():
-    """Get real data from Tuya device with improved error handling"""
-    global real_device
+def compress_csv_log(path):
+    """Gzip a closed CSV log next to itself and remove the original"""
     try:
-        if not real_device:
-            real_device = tinytuya.OutletDevice(
-                dev_id=REAL_DEVICE_CONFIG['dev_id'],
-                address=REAL_DEVICE_CONFIG['address'],
-                local_key=REAL_DEVICE_CONFIG['local_key'],
-                version=REAL_DEVICE_CONFIG['version']
-            )
-            real_device.set_socketTimeout(5)
-        
-        data = real_device.status()
-        print(f"Real device data: {data}")
-        
-        if 'dps' in data:
-            dps = data['dps']
-            return {
-                'status': 'online',
-                'state': dps.get('1', False),
-                'voltage': dps.get('20', 2200) / 10.0,
-                'current': dps.get('18', 0) / 1000.0,
-                'power': dps.get('19', 0) / 10.0,
-                'energy': dps.get('17', 0) / 1000.0
-            }
-        else:
-            return {'status': 'offline'}
-            
+        with open(path, 'rb') as source, gzip.open(f'{path}.gz', 'wb') as target:
+            shutil.copyfileobj(source, target, CSV_BUFFER_SIZE)
+        os.remove(path)
     except Exception as e:
-        print(f"Error getting real device data: {e}")
-        return {'status': 'offline'}
-
-def update_devices():
-    """Update device data periodically"""
-    while True:
-        try:
-            current_time = datetime.now()
-            
-            # Update real device
-            real_data = get_real_device_data()
-            if 'device_001' in devices_data:
-                device = devices_data['device_001']
-                if real_data['status'] == 'online':
-                    device['status'] = 'online'
-                    device['state'] = real_data['state']
-                    device['voltage'] = real_data['voltage']
-                    device['current'] = real_data['current']
-                    device['power'] = real_data['power']
-                    device['energy'] = real_data['energy']
-                    device['uptime'] = int((current_time - device_start_time).total_seconds())
-                    device['cost_today'] = round(device['energy'] * settings['electricity_rate'], 2)
-                    device['last_updated'] = current_time
-                else:
-                    device['status'] = 'offline'
-            
-            # Update simulated devices with more realistic behavior
-            for device_id, device in devices_data.items():
-                if not device['is_real'] and device['status'] == 'online':
-                    if device['state']:
-                        # Device is ON - consume power
-                        base_power = {
-                            'Smart Plug': random.uniform(10, 100),
-                            'Smart Switch': random.uniform(5, 50),
-                            'Smart Bulb': random.uniform(8, 25),
-                            'Smart Fan': random.uniform(50, 120),
-                            'Smart AC': random.uniform(800, 2000)
-                        }.get(device['type'], 50)
-                        
-                        device['power'] = base_power + random.uniform(-base_power*0.1, base_power*0.1)
-                        device['voltage'] = max(200, min(240, device['voltage'] + random.uniform(-1, 1)))
-                        device['current'] = device['power'] / device['voltage']
-                        device['energy'] += device['power'] * settings['update_interval'] / 3600000  # Convert to kWh
-                    else:
-                        # Device is OFF - standby power
-                        device['current'] = random.uniform(0.001, 0.005)
-                        device['power'] = device['voltage'] * device['current']
-                        device['energy'] += device['power'] * settings['update_interval'] / 3600000
-                    
-                    device['cost_today'] = round(device['energy'] * settings['electricity_rate'], 2)
-                    device['uptime'] += settings['update_interval']
-                    device['last_updated'] = current_time
-                    
-                    # Randomly change device status occasionally
-                    if random.random() < 0.001:  # 0.1% chance per update
-                        device['status'] = random.choice(['online', 'offline'])
-            
-            # Log data and emit updates
-            log_data_to_csv()
-            save_historical_data_to_db()
-            
-            try:
-                serializable_devices = serialize_device_data(devices_data)
-                statistics = calculate_statistics()
-                socketio.emit('device_update', {
-                    'devices': serializable_devices,
-                    'timestamp': current_time.isoformat(),
-                    'statistics': statistics
-                })
-            except Exception as emit_error:
-                print(f"Error emitting WebSocket data: {emit_error}")
-            
-        except Exception as e:
-            print(f"Error in update_devices: {e}")
-        
-        time.sleep(settings['update_interval'])
+        print(f"Error compressing {path}: {e}")
 
-def calculate_statistics():
-    """Calculate dashboard statistics"""
-    online_devices = sum(1 for d in devices_data.values() if d['status'] == 'online')
-    active_devices = sum(1 for d in devices_data.values() if d['state'] and d['status'] == 'online')
-    total_power = sum(d['power'] for d in devices_data.values() if d['status'] == 'online')
-    total_cost = sum(d['cost_today'] for d in devices_data.values())
-    
-    return {
-        'total_devices': len(devices_data),
-        'online_devices': online_devices,
-        'offline_devices': len(devices_data) - online_devices,
-        'active_devices': active_devices,
-        'total_power': round(total_power, 2),
-        'total_cost': round(total_cost, 2)
-    }
+csv_logger = CsvLogWriter('data')
 
-def log_data_to_csv():
+def log_data_to_csv(current_time):
     """Log device data to CSV files with size management"""
     try:
-        os.makedirs('data', exist_ok=True)
-        
-        timestamp = datetime.now().strftime('%Y%m%d_%H')
-        filename = f'data/iot_data_{timestamp}.csv'
-        
-        # Check file size and create new file if needed
-        if os.path.exists(filename):
-            file_size_mb = os.path.getsize(filename) / (1024 * 1024)
-            if file_size_mb >= settings['file_size_limit']:
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f'data/iot_data_{timestamp}.csv'
-        
-        file_exists = os.path.exists(filename)
-        
-        with open(filename, 'a', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['timestamp', 'device_id', 'name', 'status', 'state', 'voltage', 'current', 'power', 'energy', 'cost']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            if not file_exists:
-                writer.writeheader()
-            
-            for device_id, device in devices_data.items():
-                writer.writerow({
-                    'timestamp': datetime.now().isoformat(),
-                    'device_id': device_id,
-                    'name': device['name'],
-                    'status': device['status'],
-                    'state': device['state'],
-                    'voltage': device['voltage'],
-                    'current': device['current'],
-                    'power': device['power'],
-                    'energy': device['energy'],
-                    'cost': device['cost_today']
-                })
-                
+        # Copy the tick out under the store lock; formatting and writing it happen without
+        with devices_data.lock:
+            rows = devices_data.live_rows()
+            columns = devices_data.columns
+            records = devices_data.records
+            ids = devices_data.ids[rows].tolist()
+            names = [records[row].name for row in rows.tolist()]
+            online = columns['online'][rows]
+            values = [columns[name][rows] for name in ('state', 'voltage', 'current', 'power', 'energy', 'cost_today')]
+        csv_logger.write_tick(current_time, zip(
+            ids, names, np.where(online, 'online', 'offline').tolist(), *(column.tolist() for column in values)
+        ))
     except Exception as e:
         print(f"Error logging data: {e}")
 
-def save_historical_data_to_db():
-    """Save historical data to database"""
-    try:
-        conn = sqlite3.connect('iot_dashboard.db')
-        cursor = conn.cursor()
-        
-        for device_id, device in devices_data.items():
-            cursor.execute('''
-                INSERT INTO historical_data 
-                (device_id, voltage, current, power, energy, cost)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                device_id, device['voltage'], device['current'],
-                device['power'], device['energy'], device['cost_today']
+class RollupTier:
+    """Running per-device min/max/mean/last and energy delta for the open bucket of one tier"""
+    
+    def __init__(self, name, seconds, capacity):
+        self.name = name
+        self.seconds = seconds
+        self.bucket = None
+        metric_columns = ', '.join(
+            f'{metric}_min, {metric}_max, {metric}_mean, {metric}_last' for metric in ROLLUP_METRICS
+        )
+        merges = ', '.join(
+            f'{metric}_min = min({metric}_min, excluded.{metric}_min), '
+            f'{metric}_max = max({metric}_max, excluded.{metric}_max), '
+            f'{metric}_mean = ({metric}_mean * samples + excluded.{metric}_mean * excluded.samples)'
+            f' / (samples + excluded.samples), '
+            f'{metric}_last = excluded.{metric}_last'
+            for metric in ROLLUP_METRICS
+        )
+        # A bucket can be written more than once (periodic flushes, restarts); merge into the stored row
+        self.upsert_sql = f'''
+            INSERT INTO rollup_{name}
+            (device_id, bucket, samples, {metric_columns}, energy_delta, energy_last)
+            VALUES ({', '.join('?' * (5 + 4 * len(ROLLUP_METRICS)))})
+            ON CONFLICT (device_id, bucket) DO UPDATE SET
+            {merges},
+            energy_delta = energy_delta + excluded.energy_delta,
+            energy_last = excluded.energy_last,
+            samples = samples + excluded.samples
+        '''
+        self.energy_start = np.full(capacity, np.nan)
+        self.energy_last = np.zeros(capacity)
+        self.reset(capacity)
+    
+    def reset(self, capacity):
+        self.samples = np.zeros(capacity, dtype=np.int64)
+        self.min = {metric: np.full(capacity, np.inf) for metric in ROLLUP_METRICS}
+        self.max = {metric: np.full(capacity, -np.inf) for metric in ROLLUP_METRICS}
+        self.sum = {metric: np.zeros(capacity) for metric in ROLLUP_METRICS}
+        self.last = {metric: np.zeros(capacity) for metric in ROLLUP_METRICS}
+    
+    def grow(self, capacity):
+        """Extend every per-device array to capacity slots"""
+        def extend(array, fill):
+            grown = np.full(capacity, fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+        self.samples = extend(self.samples, 0)
+        self.energy_start = extend(self.energy_start, np.nan)
+        self.energy_last = extend(self.energy_last, 0)
+        for metric in ROLLUP_METRICS:
+            self.min[metric] = extend(self.min[metric], np.inf)
+            self.max[metric] = extend(self.max[metric], -np.inf)
+            self.sum[metric] = extend(self.sum[metric], 0)
+            self.last[metric] = extend(self.last[metric], 0)
+    
+    def add(self, slots, columns):
+        """Fold one tick of samples into the open bucket"""
+        self.samples[slots] += 1
+        for metric in ROLLUP_METRICS:
+            values = columns[metric]
+            self.min[metric][slots] = np.minimum(self.min[metric][slots], values)
+            self.max[metric][slots] = np.maximum(self.max[metric][slots], values)
+            self.sum[metric][slots] += values
+            self.last[metric][slots] = values
+        energy = columns['energy']
+        fresh = np.isnan(self.energy_start[slots])
+        self.energy_start[slots[fresh]] = energy[fresh]
+        self.energy_last[slots] = energy
+    
+    def flush(self, conn, ids):
+        """Write the open bucket's aggregates and start accumulating from zero again"""
+        if self.bucket is None:
+            return 0
+        rows = np.flatnonzero(self.samples)
+        if len(rows):
+            samples = self.samples[rows]
+            bucket = datetime.fromtimestamp(self.bucket, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            columns = [samples.tolist()]
+            for metric in ROLLUP_METRICS:
+                columns.append(self.min[metric][rows].tolist())
+                columns.append(self.max[metric][rows].tolist())
+                columns.append((self.sum[metric][rows] / samples).tolist())
+                columns.append(self.last[metric][rows].tolist())
+            # Counter resets on real plugs would otherwise show up as negative consumption
+            energy_delta = np.maximum(self.energy_last[rows] - self.energy_start[rows], 0)
+            columns.append(energy_delta.tolist())
+            columns.append(self.energy_last[rows].tolist())
+            conn.executemany(self.upsert_sql, (
+                (ids[row], bucket, *values) for row, values in zip(rows.tolist(), zip(*columns))
             ))
-        
-        # Clean old data (keep only last 7 days)
-        week_ago = datetime.now() - timedelta(days=7)
-        cursor.execute('DELETE FROM historical_data WHERE timestamp < ?', (week_ago,))
-        
-        conn.commit()
+            self.energy_start[rows] = self.energy_last[rows]
+        self.reset(len(self.samples))
+        return len(rows)
+
+class RollupAggregator:
+    """Maintains every rollup tier incrementally from the ticks the telemetry writer receives"""
+    
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.slots = {}
+        self.ids = []
+        self.last_ids = None
+        self.last_slots = None
+        self.minute = None
+        self.tiers = [RollupTier(name, seconds, capacity) for name, (seconds, _) in ROLLUP_TIERS.items()]
+    
+    def slots_for(self, ids):
+        """Map device ids to stable array slots, reusing the previous mapping when the fleet is unchanged"""
+        if ids == self.last_ids:
+            return self.last_slots
+        for device_id in ids:
+            if device_id not in self.slots:
+                self.slots[device_id] = len(self.ids)
+                self.ids.append(device_id)
+        if len(self.ids) > self.capacity:
+            while self.capacity < len(self.ids):
+                self.capacity *= 2
+            for tier in self.tiers:
+                tier.grow(self.capacity)
+        self.last_ids = ids
+        self.last_slots = np.fromiter((self.slots[device_id] for device_id in ids), np.int64, len(ids))
+        return self.last_slots
+    
+    def add(self, conn, timestamp, ids, columns):
+        """Fold one tick into all tiers; every minute boundary flushes all open buckets"""
+        epoch = int(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp())
+        minute = epoch - epoch % 60
+        if minute != self.minute:
+            self.flush(conn)
+            self.minute = minute
+            for tier in self.tiers:
+                tier.bucket = epoch - epoch % tier.seconds
+        slots = self.slots_for(ids)
+        for tier in self.tiers:
+            tier.add(slots, columns)
+    
+    def flush(self, conn):
+        return sum(tier.flush(conn, self.ids) for tier in self.tiers)
+    
+
+class TelemetryWriter:
+    """Background thread that owns one SQLite connection and batch-inserts queued ticks"""
+    
+    INSERT_SQL = '''
+        INSERT INTO {table}
+        (device_id, timestamp, voltage, current, power, energy, cost)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=TELEMETRY_QUEUE_TICKS)
+        self.thread = None
+        self.rows_written = 0
+        self.ticks_written = 0
+        self.commits = 0
+        self.dropped_ticks = 0
+        self.write_seconds = 0.0
+        self.last_retention_sweep = None
+        self.known_tables = set()
+        self.rollups = RollupAggregator()
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='telemetry-writer', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Flush everything queued so far and stop the writer thread"""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+    
+    def submit(self, timestamp, ids, columns):
+        """Queue one tick of column arrays without ever blocking the caller"""
+        try:
+            self.queue.put_nowait((timestamp, ids, columns))
+        except queue.Full:
+            self.dropped_ticks += 1
+    
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+    
+    def run(self):
+        conn = self.connect()
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            # Fell behind: fold everything already waiting into the same commit
+            while len(batch) < TELEMETRY_BATCH_TICKS:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [tick for tick in batch if tick is not None]
+            if batch:
+                self.write(conn, batch)
+            self.sweep_retention(conn)
+        # Keep partially filled rollup buckets; they merge with later writes of the same bucket
+        try:
+            with conn:
+                self.rollups.flush(conn)
+        except Exception as e:
+            print(f"Error saving rollups: {e}")
         conn.close()
+    
+    def write(self, conn, batch):
+        started = time.perf_counter()
+        try:
+            with conn:
+                for timestamp, ids, columns in batch:
+                    table = history_table_name(timestamp)
+                    if table not in self.known_tables:
+                        create_history_table(conn, table)
+                        self.known_tables.add(table)
+                    conn.executemany(self.INSERT_SQL.format(table=table), zip(
+                        ids, repeat(timestamp), columns['voltage'].tolist(), columns['current'].tolist(),
+                        columns['power'].tolist(), columns['energy'].tolist(), columns['cost'].tolist()
+                    ))
+                    self.rollups.add(conn, timestamp, ids, columns)
+        except Exception as e:
+            print(f"Error saving historical data: {e}")
+            self.known_tables.clear()
+            return
+        self.write_seconds += time.perf_counter() - started
+        self.rows_written += sum(len(ids) for _, ids, _ in batch)
+        self.ticks_written += len(batch)
+        self.commits += 1
+    
+    def sweep_retention(self, conn):
+        """Drop expired day tables, at most once per sweep interval"""
+        now = time.monotonic()
+        if self.last_retention_sweep is not None and now - self.last_retention_sweep < RETENTION_SWEEP_INTERVAL:
+            return
+        self.last_retention_sweep = now
+        try:
+            with conn:
+                expired = drop_expired_history_tables(conn.cursor())
+                for tier, (_, retention_days) in ROLLUP_TIERS.items():
+                    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+                    conn.execute(f'DELETE FROM rollup_{tier} WHERE bucket < ?',
+                                 (cutoff.strftime('%Y-%m-%d %H:%M:%S'),))
+            self.known_tables.difference_update(expired)
+        except Exception as e:
+            print(f"Error cleaning old historical data: {e}")
+    
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'rows_written': self.rows_written,
+            'ticks_written': self.ticks_written,
+            'commits': self.commits,
+            'dropped_ticks': self.dropped_ticks,
+            'rows_per_second': round(self.rows_written / self.write_seconds) if self.write_seconds else 0
+        }
+
+telemetry_writer = TelemetryWriter('iot_dashboard.db')
+
+class RecentHistory:
+    """The last RECENT_HISTORY_SAMPLES raw samples of the devices whose history was asked for lately,
+    so chart refreshes over the recent past are answered without SQLite. A device's first query is
+    answered from storage and starts its ring; at most RECENT_HISTORY_DEVICES are kept, the least
+    recently queried dropped first. One 2-D array per metric indexed by [ring, slot], with slots
+    shared by all rings since every watched device is sampled each tick."""
+    
+    METRICS = ('voltage', 'current', 'power', 'energy')
+    
+    def __init__(self, samples=RECENT_HISTORY_SAMPLES, devices=RECENT_HISTORY_DEVICES):
+        self.samples = samples
+        self.lock = threading.Lock()
+        self.ticks = 0  # ticks recorded so far; tick n lives in slot n % samples
+        self.times = np.zeros(samples, dtype=np.int64)  # epoch seconds of each slot
+        self.values = {metric: np.zeros((devices, samples)) for metric in self.METRICS}
+        self.watched = OrderedDict()  # device_id -> ring, most recently queried last
+        self.rows = np.zeros(devices, dtype=np.int64)  # store row of each ring's device
+        self.first_tick = np.zeros(devices, dtype=np.int64)  # first tick recorded in each ring
+        self.free = list(range(devices))
+    
+    def _watch(self, device_id, row):
+        if self.free:
+            ring = self.free.pop()
+        else:
+            _, ring = self.watched.popitem(last=False)
+        self.watched[device_id] = ring
+        self.rows[ring] = row
+        self.first_tick[ring] = self.ticks
+    
+    def record(self, epoch, rows, ids, columns):
+        """Add one tick: rows are the store's live rows, ascending, and ids and every metric column are aligned with them"""
+        with self.lock:
+            slot = self.ticks % self.samples
+            self.times[slot] = epoch
+            if self.watched and len(rows):
+                watched = list(self.watched.items())
+                rings = np.array([ring for _, ring in watched], dtype=np.int64)
+                positions = np.minimum(np.searchsorted(rows, self.rows[rings]), len(rows) - 1)
+                present = (rows[positions] == self.rows[rings]) & (ids[positions] == np.array(
+                    [device_id for device_id, _ in watched], dtype=object))
+                for index in np.flatnonzero(~present).tolist():
+                    # Removed, or its row now holds another device
+                    del self.watched[watched[index][0]]
+                    self.free.append(watched[index][1])
+                for metric in self.METRICS:
+                    self.values[metric][rings[present], slot] = columns[metric][positions[present]]
+            elif self.watched:
+                self.free.extend(self.watched.values())
+                self.watched.clear()
+            self.ticks += 1
+    
+    def query(self, device_id, start=None, end=None, limit=HISTORY_LIMIT):
+        """Newest-first (timestamp, voltage, current, power, energy) rows like iter_device_history's,
+        or None when memory doesn't hold the whole answer and storage has to be read instead"""
+        device = devices_data.get(device_id)
+        if device is None:
+            return None
+        with self.lock:
+            ring = self.watched.get(device_id)
+            if ring is None or self.rows[ring] != device.row:
+                self.watched.pop(device_id, None)
+                if ring is not None:
+                    self.free.append(ring)
+                self._watch(device_id, device.row)
+                return None
+            self.watched.move_to_end(device_id)
+            available = min(self.ticks - self.first_tick[ring], self.samples)
+            slots = np.arange(self.ticks - available, self.ticks) % self.samples
+            times = self.times[slots]
+            values = [self.values[metric][ring, slots] for metric in self.METRICS]
+        
+        if start and end:
+            start_epoch = datetime.strptime(start, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+            end_epoch = datetime.strptime(end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+            if not len(times) or times[0] > start_epoch:
+                return None  # the window reaches back before what memory holds
+            keep = np.flatnonzero((times >= start_epoch) & (times <= end_epoch))[-limit:]
+        else:
+            if available < limit:
+                return None
+            keep = np.arange(available - limit, available)
+        
+        timestamps = [datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+                      for epoch in times[keep].tolist()]
+        columns = [column[keep].tolist() for column in values]
+        return list(zip(timestamps, *columns))[::-1]
+
+recent_history = RecentHistory()
+
+def save_historical_data_to_db():
+    """Queue this tick's readings for the telemetry writer"""
+    # Same UTC format SQLite's CURRENT_TIMESTAMP produced for older rows
+    now = datetime.now(timezone.utc)
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    with devices_data.lock:
+        rows = devices_data.live_rows()
+        ids = devices_data.ids[rows]
+        columns = {
+            name: devices_data.columns[field][rows]
+            for name, field in (('voltage', 'voltage'), ('current', 'current'), ('power', 'power'),
+                                ('energy', 'energy'), ('cost', 'cost_today'))
+        }
+    recent_history.record(int(now.timestamp()), rows, ids, columns)
+    telemetry_writer.submit(timestamp, ids.tolist(), columns)
+
+def csv_stream_response(conn, header, rows, filename):
+    """Stream rows from an open cursor as CSV in fixed-size chunks, gzipped if the client accepts it"""
+    use_gzip = request.accept_encodings.best_match(('gzip',)) is not None
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
         
-    except Exception as e:
-        print(f"Error saving historical data: {e}")
+        def take_chunk():
+            chunk = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(chunk) if compressor else chunk
+        
+        try:
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+                if buffer.tell() >= EXPORT_CHUNK_SIZE:
+                    chunk = take_chunk()
+                    if chunk:
+                        yield chunk
+            chunk = take_chunk()
+            if compressor:
+                chunk += compressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            conn.close()
+    
+    headers = {'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept-Encoding'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(generate(), mimetype='text/csv', headers=headers)
+
+class VersionedBody:
+    """One endpoint's encoded body and its compressed forms, kept for a single state version"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.body = None
+        self.compressed = {}
+    
+    def get(self, version, build, encoding=None):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.body = build().encode('utf-8')
+                self.compressed = {}
+            if encoding is None:
+                return self.body
+            data = self.compressed.get(encoding)
+            if data is None:
+                # wbits 31 writes a gzip container, 15 the zlib stream HTTP calls deflate
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+                data = self.compressed[encoding] = compressor.compress(self.body) + compressor.flush()
+            return data
+
+devices_body = VersionedBody()
+settings_body = VersionedBody()
+system_status_body = VersionedBody()
+
+def versioned_response(cache, version, modified, build):
+    """JSON response for one state version: 304 when the client has it, compressed when large"""
+    etag = f'{SERVER_INSTANCE}-{version}'
+    headers = {
+        'ETag': f'W/"{etag}"',
+        'Last-Modified': http_date(modified),
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and int(modified) <= since.timestamp()
+    if not_modified:
+        return Response(status=304, headers=headers)
+    
+    body = cache.get(version, build)
+    encoding = None
+    if len(body) >= COMPRESS_MIN_SIZE:
+        encoding = request.accept_encodings.best_match(('gzip', 'deflate'))
+    if encoding:
+        body = cache.get(version, build, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
+def list_devices(snapshot, location=None, device_type=None, status=None, sort='id', cursor=None,
+                 limit=None, fields=None):
+    """Body of a filtered GET /api/devices: matching devices in sort order, a page of them when limit is
+    given. Pages are keyed on the last device's (sort value, id), so a cursor stays valid while devices
+    come and go. Raises ValueError for a bad sort field, cursor or field name."""
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in DEVICE_SORT_CONFIG_FIELDS and sort not in DEVICE_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(DEVICE_SORT_CONFIG_FIELDS + tuple(DEVICE_SORT_COLUMNS))}")
+    if fields is not None:
+        unknown = set(fields) - set(DEVICE_SERIALIZED_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        fields = ['id'] + [field for field in DEVICE_SERIALIZED_FIELDS if field in fields and field != 'id']
+    
+    rows = snapshot.select_rows(location, device_type, status)
+    ids = snapshot.columns['ids'][rows]
+    if sort in DEVICE_SORT_COLUMNS:
+        keys = snapshot.columns[DEVICE_SORT_COLUMNS[sort]][rows]
+    else:
+        keys = np.array([getattr(snapshot.records[row], sort) for row in rows.tolist()], dtype=object)
+    
+    if cursor:
+        try:
+            after_key, after_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if descending:
+                keep = (keys < after_key) | ((keys == after_key) & (ids < after_id))
+            else:
+                keep = (keys > after_key) | ((keys == after_key) & (ids > after_id))
+            keep = np.asarray(keep, dtype=bool)
+        except (ValueError, TypeError):
+            raise ValueError('Invalid cursor')
+        rows, ids, keys = rows[keep], ids[keep], keys[keep]
+    
+    # Ranks make object (string) keys sortable by lexsort; ids break ties
+    sort_keys = np.unique(keys, return_inverse=True)[1] if keys.dtype == object else keys
+    order = np.lexsort((np.unique(ids, return_inverse=True)[1], sort_keys))
+    if descending:
+        order = order[::-1]
+    next_cursor = None
+    if limit is not None and len(order) > limit:
+        order = order[:limit]
+        last = order[-1]
+        next_cursor = base64.urlsafe_b64encode(
+            json.dumps([keys[last].item() if keys.dtype != object else keys[last], ids[last]]).encode()
+        ).decode()
+    
+    devices = devices_data.serialize(rows[order], snapshot.columns, snapshot.records)
+    if fields is not None:
+        devices = {device_id: {field: device[field] for field in fields} for device_id, device in devices.items()}
+    return (f'{{"devices":{json.dumps(devices)},"count":{len(devices)},"next_cursor":{json.dumps(next_cursor)},'
+            f'"timestamp":{snapshot.timestamp_json}}}')
+
+def parse_poll_interval(value):
+    """Seconds between samples from an API request; None means the device type's default"""
+    if value is None or value == '':
+        return None
+    interval = float(value)
+    if interval <= 0:
+        raise ValueError('Poll interval must be positive')
+    return interval
+
+# Commands the update loop applies for the API (see run_in_update_loop)
+def create_device(device_data):
+    """Add a device under the next free id; returns its config"""
+    device_data = dict(device_data, id=get_next_device_id())
+    device = devices_data.add(
+        device_data,
+        status='online' if device_data['is_real'] else random.choice(['online', 'offline']),
+        voltage=220.0
+    )
+    fleet_stats.update(device)
+    return device_data
+
+def edit_device(device_id, changes):
+    if device_id not in devices_data:
+        raise LookupError('Device not found')
+    device = devices_data.update(device_id, **changes)
+    device.last_updated = datetime.now()
+    fleet_stats.update(device)
+    return device.config()
+
+def remove_device(device_id):
+    device = devices_data.get(device_id)
+    if device is None:
+        raise LookupError('Device not found')
+    # Don't allow deletion of real device
+    if device.is_real:
+        raise ValueError('Cannot delete real device')
+    devices_data.remove(device_id)
+    fleet_stats.remove(device)
+
+def set_device_state(device_id, state):
+    device = devices_data.get(device_id)
+    if device is None:
+        raise LookupError('Device not found')
+    device.state = state
+    device.last_updated = datetime.now()
+    fleet_stats.update(device)
+    return device.state
+
+def set_device_states(device_ids, state):
+    """Switch many devices in one command, so the whole batch goes out in one published snapshot"""
+    now = datetime.now()
+    states = {}
+    for device_id in device_ids:
+        device = devices_data.get(device_id)
+        if device is None:
+            states[device_id] = None
+            continue
+        device.state = state
+        device.last_updated = now
+        fleet_stats.update(device)
+        states[device_id] = device.state
+    return states
+
+def select_devices(selector):
+    """Devices matching every field of a {location, type, state} selector"""
+    unknown = set(selector) - {'location', 'type', 'state'}
+    if unknown:
+        raise ValueError(f"Unknown selector fields: {', '.join(sorted(unknown))}")
+    if not selector:
+        # Never read an empty selector as "every device"; switching the fleet has to be asked for by name
+        raise ValueError('Selector needs at least one of location, type, state')
+    state = selector.get('state')
+    state = {'on': True, 'off': False}.get(state, state)
+    if state is not None and not isinstance(state, bool):
+        raise ValueError('Selector state must be "on", "off", true or false')
+    
+    with devices_data.lock:
+        rows = devices_data.live_rows()
+        if state is not None:
+            rows = rows[devices_data.columns['state'][rows] == state]
+        records = [devices_data.records[row] for row in rows.tolist()]
+    return [device for device in records
+            if all(getattr(device, field) == value for field, value in selector.items() if field != 'state')]
+
+def apply_settings(changes):
+    global settings_version, settings_modified
+    settings.update(changes)
+    settings_version += 1
+    settings_modified = time.time()
+    return dict(settings)
+
+ingest_url = None  # set in web worker processes of a split deployment
+
+# What a web worker passes on to the ingest process: every change, plus reads only the ingest can answer
+INGEST_ENDPOINTS = {'get_system_status'}
+FORWARDED_REQUEST_HEADERS = ('Content-Type', 'Accept-Encoding', 'If-None-Match', 'If-Modified-Since')
+# /metrics families a web worker reports itself: the Socket.IO clients are its own, the rest is the ingest's
+WORKER_METRIC_FAMILIES = ('iot_emitted_frames_total', 'iot_emitted_bytes_total', 'iot_dropped_frames_total',
+                          'iot_socketio_clients', 'iot_socketio_clients_behind', 'iot_socketio_client_max_lag_ticks')
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'Content-Encoding', 'Content-Disposition', 'ETag',
+                              'Last-Modified', 'Cache-Control', 'Vary')
+
+@app.before_request
+def forward_to_ingest():
+    """In a web worker, send writes and ingest-only reads to the ingest process and relay its answer"""
+    if ingest_url is None:
+        return None
+    if request.method in ('GET', 'HEAD', 'OPTIONS') and request.endpoint not in INGEST_ENDPOINTS:
+        return None
+    
+    url = ingest_url + request.path
+    if request.query_string:
+        url += '?' + request.query_string.decode()
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    forwarded = urllib.request.Request(url, data=request.get_data() or None, headers=headers, method=request.method)
+    try:
+        reply = urllib.request.urlopen(forwarded, timeout=UPDATE_COMMAND_TIMEOUT + 2 * POLL_DEADLINE + 1)
+    except urllib.error.HTTPError as e:
+        reply = e
+    except urllib.error.URLError as e:
+        return jsonify({'success': False, 'error': f'Ingest process unavailable: {e.reason}'}), 503
+    with reply:
+        response = Response(reply.read(), status=reply.getcode(), headers=[
+            (name, reply.headers[name]) for name in FORWARDED_RESPONSE_HEADERS if name in reply.headers
+        ])
+    if request.method not in ('GET', 'HEAD'):
+        # The ingest publishes before it answers, so the change is in the ring already
+        refresh_shared_snapshot()
+    return response
 
 # Flask Routes
 @app.route('/')
@@ -492,18 +3022,50 @@ def dashboard():
 
 @app.route('/api/devices')
 def get_devices():
-    serializable_devices = serialize_device_data(devices_data)
+    """The whole fleet with statistics, or with location/type/status/sort/cursor/limit/fields
+    parameters a filtered listing of just the devices and fields asked for"""
+    snapshot = current_snapshot
+    args = request.args
+    if not any(name in args for name in ('location', 'type', 'status', 'sort', 'cursor', 'limit', 'fields')):
+        return versioned_response(devices_body, snapshot.version, snapshot.modified, snapshot.devices_body)
+    
+    status = args.get('status')
+    if status not in (None, 'online', 'offline'):
+        return jsonify({'success': False, 'error': 'status must be online or offline'}), 400
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= DEVICE_PAGE_MAX:
+            return jsonify({'success': False, 'error': f'limit must be an integer from 1 to {DEVICE_PAGE_MAX}'}), 400
+    fields = args.get('fields')
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields is not None else None
+    # Built per request, but still answered with 304 while the snapshot hasn't moved
+    try:
+        return versioned_response(VersionedBody(), snapshot.version, snapshot.modified, lambda: list_devices(
+            snapshot, args.get('location'), args.get('type'), status, args.get('sort', 'id'), args.get('cursor'),
+            limit, fields
+        ))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/statistics')
+def get_statistics():
+    """Fleet totals with per-location and per-type breakdowns, as of the last published snapshot"""
+    statistics = current_snapshot.statistics
     return jsonify({
-        'devices': serializable_devices,
-        'timestamp': datetime.now().isoformat(),
-        'statistics': calculate_statistics()
+        'statistics': {key: value for key, value in statistics.items() if not key.startswith('by_')},
+        'by_location': statistics['by_location'],
+        'by_type': statistics['by_type'],
+        'timestamp': datetime.now().isoformat()
     })
 
 @app.route('/api/devices', methods=['POST'])
 def add_device():
     try:
         data = request.get_json()
-        device_id = get_next_device_id()
         
         # Validate input
         if not data.get('name') or not data.get('type') or not data.get('location'):
@@ -511,46 +3073,28 @@ def add_device():
         
         # Create new device
         device_data = {
-            'id': device_id,
             'name': data['name'],
             'type': data['type'],
             'location': data['location'],
             'ip_address': data.get('ip_address'),
             'tuya_device_id': data.get('device_id'),
             'local_key': data.get('local_key'),
-            'is_real': bool(data.get('device_id') and data.get('local_key'))
-        }
-        
-        devices_data[device_id] = {
-            'id': device_id,
-            'name': device_data['name'],
-            'type': device_data['type'],
-            'location': device_data['location'],
-            'ip_address': device_data['ip_address'],
-            'tuya_device_id': device_data['tuya_device_id'],
-            'local_key': device_data['local_key'],
-            'status': 'online' if device_data['is_real'] else random.choice(['online', 'offline']),
-            'state': False,
-            'voltage': 220.0,
-            'current': 0.0,
-            'power': 0.0,
-            'energy': 0.0,
-            'temperature': 25.0,
-            'humidity': 60.0,
-            'last_updated': datetime.now(),
-            'is_real': device_data['is_real'],
-            'cost_today': 0.0,
-            'uptime': 0
+            'tuya_version': float(data.get('version') or REAL_DEVICE_CONFIG['version']),
+            'is_real': bool(data.get('device_id') and data.get('local_key')),
+            'poll_interval': parse_poll_interval(data.get('poll_interval'))
         }
         
+        device_data = run_in_update_loop(create_device, device_data)
         save_device_to_db(device_data)
         
         return jsonify({
             'success': True,
-            'device_id': device_id,
+            'device_id': device_data['id'],
             'message': 'Device added successfully'
         })
         
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"Error adding device: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -562,29 +3106,18 @@ def update_device(device_id):
             return jsonify({'success': False, 'error': 'Device not found'}), 404
         
         data = request.get_json()
-        device = devices_data[device_id]
         
         # Validate input
         if not data.get('name') or not data.get('type') or not data.get('location'):
             return jsonify({'success': False, 'error': 'Name, type, and location are required'}), 400
         
         # Update device data
-        device['name'] = data['name']
-        device['type'] = data['type']
-        device['location'] = data['location']
-        device['last_updated'] = datetime.now()
+        changes = {'name': data['name'], 'type': data['type'], 'location': data['location']}
+        if 'poll_interval' in data:
+            changes['poll_interval'] = parse_poll_interval(data['poll_interval'])
+        device_data = run_in_update_loop(edit_device, device_id, changes)
         
         # Update in database
-        device_data = {
-            'id': device_id,
-            'name': data['name'],
-            'type': data['type'],
-            'location': data['location'],
-            'ip_address': device.get('ip_address'),
-            'tuya_device_id': device.get('tuya_device_id'),
-            'local_key': device.get('local_key'),
-            'is_real': device['is_real']
-        }
         save_device_to_db(device_data)
         
         return jsonify({
@@ -592,6 +3125,10 @@ def update_device(device_id):
             'message': 'Device updated successfully'
         })
         
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"Error updating device: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -602,11 +3139,7 @@ def delete_device(device_id):
         if device_id not in devices_data:
             return jsonify({'success': False, 'error': 'Device not found'}), 404
         
-        # Don't allow deletion of real device
-        if devices_data[device_id]['is_real']:
-            return jsonify({'success': False, 'error': 'Cannot delete real device'}), 400
-        
-        del devices_data[device_id]
+        run_in_update_loop(remove_device, device_id)
         delete_device_from_db(device_id)
         
         return jsonify({
@@ -614,6 +3147,10 @@ def delete_device(device_id):
             'message': 'Device deleted successfully'
         })
         
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"Error deleting device: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -632,85 +3169,183 @@ def control_device(device_id):
         
         device = devices_data[device_id]
         
-        if device['is_real'] and real_device:
+        if is_pollable(device):
             try:
-                if action == 'on':
-                    result = real_device.turn_on()
-                    device['state'] = True
-                elif action == 'off':
-                    result = real_device.turn_off()
-                    device['state'] = False
+                device_io.control(device_id, tuya_connection_params(device), action == 'on')
                 
-                device['last_updated'] = datetime.now()
+                new_state = run_in_update_loop(set_device_state, device_id, action == 'on')
                 
                 return jsonify({
                     'success': True,
                     'device_id': device_id,
                     'action': action,
-                    'new_state': device['state']
+                    'new_state': new_state
                 })
+            except (ConnectionError, TimeoutError) as e:
+                return jsonify({'success': False, 'error': f'Failed to control real device: {str(e)}'}), 503
             except Exception as e:
                 print(f"Error controlling real device: {e}")
                 return jsonify({'success': False, 'error': f'Failed to control real device: {str(e)}'}), 500
         else:
             # Simulated device
-            device['state'] = (action == 'on')
-            device['last_updated'] = datetime.now()
+            new_state = run_in_update_loop(set_device_state, device_id, action == 'on')
             return jsonify({
                 'success': True,
                 'device_id': device_id,
                 'action': action,
-                'new_state': device['state']
+                'new_state': new_state
             })
             
+    except LookupError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
     except Exception as e:
         print(f"Error controlling device: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/devices/control', methods=['POST'])
+def control_devices():
+    """Switch many devices at once, picked by "ids" or by a "selector" on location, type and state"""
+    try:
+        data = request.get_json() or {}
+        action = data.get('action')
+        ids = data.get('ids')
+        selector = data.get('selector')
+        
+        if action not in ['on', 'off']:
+            return jsonify({'success': False, 'error': 'Invalid action. Use "on" or "off"'}), 400
+        if (ids is None) == (selector is None):
+            return jsonify({'success': False, 'error': 'Give either "ids" or "selector"'}), 400
+        
+        results = {}
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(device_id, str) for device_id in ids):
+                return jsonify({'success': False, 'error': '"ids" must be a list of device ids'}), 400
+            targets = []
+            for device_id in dict.fromkeys(ids):
+                device = devices_data.get(device_id)
+                if device is None:
+                    results[device_id] = {'success': False, 'error': 'Device not found'}
+                else:
+                    targets.append(device)
+        else:
+            if not isinstance(selector, dict):
+                return jsonify({'success': False, 'error': '"selector" must be an object'}), 400
+            try:
+                targets = select_devices(selector)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Real devices are switched concurrently; only those that acknowledged change state
+        real = {device.id: tuya_connection_params(device) for device in targets if is_pollable(device)}
+        if real:
+            for device_id, reply in device_io.control_many(real, action == 'on').items():
+                if isinstance(reply, Exception):
+                    results[device_id] = {'success': False,
+                                          'error': f'Failed to control real device: {str(reply) or type(reply).__name__}'}
+        
+        switched = [device.id for device in targets if device.id not in results]
+        if switched:
+            for device_id, new_state in run_in_update_loop(set_device_states, switched, action == 'on').items():
+                if new_state is None:
+                    results[device_id] = {'success': False, 'error': 'Device not found'}
+                else:
+                    results[device_id] = {'success': True, 'new_state': new_state}
+        
+        succeeded = sum(1 for result in results.values() if result['success'])
+        return jsonify({
+            'success': succeeded == len(results),
+            'action': action,
+            'matched': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'results': results
+        })
+        
+    except Exception as e:
+        print(f"Error controlling devices: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/devices/<device_id>/history')
 def get_device_history(device_id):
     """Get historical data for device charts"""
     try:
-        if device_id not in devices_data:
+        if current_snapshot.find(device_id) is None:
             return jsonify({'success': False, 'error': 'Device not found'}), 404
             
-        start_date = request.args.get('start')
-        end_date = request.args.get('end')
-        
-        conn = sqlite3.connect('iot_dashboard.db')
-        cursor = conn.cursor()
-        
-        query = '''
-            SELECT timestamp, voltage, current, power, energy 
-            FROM historical_data 
-            WHERE device_id = ?
-        '''
-        params = [device_id]
-        
-        if start_date and end_date:
-            query += ' AND timestamp BETWEEN ? AND ?'
-            params.extend([start_date, end_date])
+        try:
+            start_date = normalize_timestamp(request.args.get('start'))
+            end_date = normalize_timestamp(request.args.get('end'))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'start and end must be ISO dates'}), 400
         
-        query += ' ORDER BY timestamp DESC LIMIT 100'
+        resolution = request.args.get('resolution', 'raw')
+        if resolution not in ('auto', 'raw', *ROLLUP_TIERS):
+            return jsonify({'success': False, 'error': 'resolution must be one of auto, raw, 1m, 15m, 1h'}), 400
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        max_points = request.args.get('max_points')
+        if max_points is not None:
+            try:
+                max_points = int(max_points)
+            except ValueError:
+                max_points = 0
+            if not 2 <= max_points <= HISTORY_MAX_POINTS:
+                return jsonify({'success': False, 'error': f'max_points must be an integer from 2 to {HISTORY_MAX_POINTS}'}), 400
+        # With max_points over a window, every sample in it is streamed through decimate_history
+        decimate = bool(max_points and start_date and end_date)
+        limit = max_points or HISTORY_LIMIT
+        resolution = choose_resolution(resolution, start_date, end_date, limit)
+        
+        rows = None
+        if resolution == 'raw':
+            rows = recent_history.query(device_id, start_date, end_date, recent_history.samples if decimate else limit)
+        if rows is not None and decimate:
+            rows = list(decimate_history(reversed(rows), start_date, end_date, max_points,
+                                         itemgetter(3), itemgetter(3)))[::-1]
+        elif rows is None:
+            conn = sqlite3.connect('iot_dashboard.db')
+            cursor = conn.cursor()
+            if resolution == 'raw' and decimate:
+                rows = iter_device_history(cursor, device_id, 'timestamp, voltage, current, power, energy',
+                                           start_date, end_date)
+                rows = list(decimate_history(rows, start_date, end_date, max_points,
+                                             itemgetter(3), itemgetter(3)))[::-1]
+            elif resolution == 'raw':
+                rows = list(islice(iter_device_history(
+                    cursor, device_id, 'timestamp, voltage, current, power, energy',
+                    start_date, end_date, newest_first=True
+                ), limit))
+            elif decimate:
+                # Rollup rows carry their bucket's extremes, so those pick the rows that are kept
+                rows = iter_rollup_history(cursor, resolution, device_id, start_date, end_date)
+                rows = list(decimate_history(rows, start_date, end_date, max_points,
+                                             itemgetter(5), itemgetter(6)))[::-1]
+            else:
+                # Rollups cover the whole window; without one, the newest `limit` buckets
+                rows = iter_rollup_history(cursor, resolution, device_id, start_date, end_date, newest_first=True)
+                rows = list(rows if start_date and end_date else islice(rows, limit))
+            conn.close()
         
         history = []
         for row in rows:
-            history.append({
+            entry = {
                 'timestamp': row[0],
                 'voltage': row[1] or 0,
                 'current': row[2] or 0,
                 'power': row[3] or 0,
                 'energy': row[4] or 0
-            })
+            }
+            if resolution != 'raw':
+                entry['power_min'] = row[5] or 0
+                entry['power_max'] = row[6] or 0
+                entry['energy_delta'] = row[7] or 0
+            history.append(entry)
         
         return jsonify({
             'device_id': device_id,
+            'resolution': resolution,
             'history': list(reversed(history)),
-            'count': len(history)
+            'count': len(history),
+            'max_points': max_points
         })
         
     except Exception as e:
@@ -721,110 +3356,70 @@ def get_device_history(device_id):
 def export_device_csv(device_id):
     """Export individual device data as CSV"""
     try:
-        if device_id not in devices_data:
+        device = current_snapshot.find(device_id)
+        if device is None:
             return jsonify({'error': 'Device not found'}), 404
         
-        start_date = request.args.get('start')
-        end_date = request.args.get('end')
-        
-        conn = sqlite3.connect('iot_dashboard.db')
-        cursor = conn.cursor()
-        
-        query = '''
-            SELECT timestamp, voltage, current, power, energy, cost
-            FROM historical_data 
-            WHERE device_id = ?
-        '''
-        params = [device_id]
-        
-        if start_date and end_date:
-            query += ' AND timestamp BETWEEN ? AND ?'
-            params.extend([start_date, end_date])
-        
-        query += ' ORDER BY timestamp'
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
+        try:
+            start_date = normalize_timestamp(request.args.get('start'))
+            end_date = normalize_timestamp(request.args.get('end'))
+        except ValueError:
+            return jsonify({'error': 'start and end must be ISO dates'}), 400
+        
+        conn = sqlite3.connect('iot_dashboard.db', check_same_thread=False)
+        rows = iter_device_history(
+            conn.cursor(), device_id, 'timestamp, voltage, current, power, energy, cost',
+            start_date, end_date
+        )
+        first = next(rows, None)
+        if first is None:
+            conn.close()
             return jsonify({'error': 'No data available for this device'}), 404
         
-        # Create CSV content
-        import io
-        output = io.StringIO()
-        fieldnames = ['timestamp', 'voltage', 'current', 'power', 'energy', 'cost']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for row in rows:
-            writer.writerow({
-                'timestamp': row[0],
-                'voltage': row[1] or 0,
-                'current': row[2] or 0,
-                'power': row[3] or 0,
-                'energy': row[4] or 0,
-                'cost': row[5] or 0
-            })
-        
-        device_name = devices_data[device_id]['name'].replace(' ', '_').replace('#', '').replace('/', '_')
+        device_name = device.name.replace(' ', '_').replace('#', '').replace('/', '_')
         filename = f"{device_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        return csv_stream_response(
+            conn,
+            ['timestamp', 'voltage', 'current', 'power', 'energy', 'cost'],
+            ((row[0], *(value or 0 for value in row[1:])) for row in chain([first], rows)),
+            filename
         )
         
     except Exception as e:
         print(f"Error exporting device data: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/export/all')
-def export_all_data():
-    """Export all device data as CSV"""
-    try:
-        conn = sqlite3.connect('iot_dashboard.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+def iter_all_history(cursor):
+    """Yield export rows for every device across all day tables, in timestamp order"""
+    for table in list_history_tables(cursor):
+        # Day tables are append-only, so rowid order is timestamp order
+        yield from cursor.execute(f'''
             SELECT hd.timestamp, d.name, d.location, d.type, 
                    hd.voltage, hd.current, hd.power, hd.energy, hd.cost
-            FROM historical_data hd
+            FROM {table} hd
             JOIN devices d ON hd.device_id = d.id
-            ORDER BY hd.timestamp
+            ORDER BY hd.rowid
         ''')
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
+
+@app.route('/api/export/all')
+def export_all_data():
+    """Export all device data as CSV"""
+    try:
+        conn = sqlite3.connect('iot_dashboard.db', check_same_thread=False)
+        rows = iter_all_history(conn.cursor())
+        first = next(rows, None)
+        if first is None:
+            conn.close()
             return jsonify({'error': 'No data available'}), 404
         
-        import io
-        output = io.StringIO()
-        fieldnames = ['timestamp', 'device_name', 'location', 'type', 'voltage', 'current', 'power', 'energy', 'cost']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for row in rows:
-            writer.writerow({
-                'timestamp': row[0],
-                'device_name': row[1],
-                'location': row[2],
-                'type': row[3],
-                'voltage': row[4] or 0,
-                'current': row[5] or 0,
-                'power': row[6] or 0,
-                'energy': row[7] or 0,
-                'cost': row[8] or 0
-            })
-        
         filename = f"all_devices_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        return csv_stream_response(
+            conn,
+            ['timestamp', 'device_name', 'location', 'type', 'voltage', 'current', 'power', 'energy', 'cost'],
+            ((*row[:4], *(value or 0 for value in row[4:])) for row in chain([first], rows)),
+            filename
         )
         
     except Exception as e:
@@ -833,40 +3428,48 @@ def export_all_data():
 
 @app.route('/api/settings')
 def get_settings():
-    return jsonify(settings)
+    return versioned_response(settings_body, settings_version, settings_modified,
+                              lambda: json.dumps(settings))
 
 @app.route('/api/settings', methods=['POST'])
 def update_settings():
     try:
-        global settings
         data = request.get_json()
         
         # Validate settings
+        changes = {}
         new_rate = data.get('electricity_rate')
         new_interval = data.get('update_interval')
         new_limit = data.get('file_size_limit')
+        new_flush_interval = data.get('csv_flush_interval')
         
         if new_rate is not None:
             if new_rate <= 0:
                 return jsonify({'success': False, 'error': 'Electricity rate must be positive'}), 400
-            settings['electricity_rate'] = float(new_rate)
+            changes['electricity_rate'] = float(new_rate)
         
         if new_interval is not None:
             if not (1 <= new_interval <= 10):
                 return jsonify({'success': False, 'error': 'Update interval must be between 1 and 10 seconds'}), 400
-            settings['update_interval'] = int(new_interval)
+            changes['update_interval'] = int(new_interval)
         
         if new_limit is not None:
             if not (1 <= new_limit <= 10):
                 return jsonify({'success': False, 'error': 'File size limit must be between 1 and 10 MB'}), 400
-            settings['file_size_limit'] = int(new_limit)
+            changes['file_size_limit'] = int(new_limit)
         
+        if new_flush_interval is not None:
+            if not (1 <= new_flush_interval <= 60):
+                return jsonify({'success': False, 'error': 'CSV flush interval must be between 1 and 60 seconds'}), 400
+            changes['csv_flush_interval'] = int(new_flush_interval)
+        
+        new_settings = run_in_update_loop(apply_settings, changes)
         save_settings_to_db()
         
         return jsonify({
             'success': True,
             'message': 'Settings updated successfully',
-            'settings': settings
+            'settings': new_settings
         })
         
     except Exception as e:
@@ -875,13 +3478,13 @@ def update_settings():
 
 @app.route('/api/system/status')
 def get_system_status():
-    """Get system status and health"""
-    try:
-        online_devices = sum(1 for d in devices_data.values() if d['status'] == 'online')
-        total_devices = len(devices_data)
+    """Get system status and health, rebuilt at most once per published snapshot or settings change"""
+    def build():
+        statistics = fleet_stats.summary()
+        online_devices = statistics['online_devices']
+        total_devices = statistics['total_devices']
         
         # Check disk space
-        import shutil
         disk_usage = shutil.disk_usage('.')
         free_space_gb = disk_usage.free / (1024**3)
         
@@ -890,51 +3493,139 @@ def get_system_status():
         if os.path.exists('iot_dashboard.db'):
             db_size = os.path.getsize('iot_dashboard.db') / (1024**2)  # MB
         
-        return jsonify({
+        return json.dumps({
             'status': 'healthy',
             'devices': {
                 'total': total_devices,
                 'online': online_devices,
-                'offline': total_devices - online_devices
+                'offline': total_devices - online_devices,
+                'unreachable': count_unreachable_devices()
             },
             'system': {
                 'free_space_gb': round(free_space_gb, 2),
                 'database_size_mb': round(db_size, 2),
                 'uptime_seconds': int((datetime.now() - device_start_time).total_seconds())
             },
+            'telemetry_writer': telemetry_writer.stats(),
+            'scheduler': {
+                'overrun_policy': TICK_OVERRUN_POLICY,
+                'tick_lag_seconds': round(metrics.last_tick_lag, 4),
+                'overruns': metrics.tick_overruns,
+                'skipped_ticks': metrics.ticks_skipped
+            },
             'settings': settings
         })
+    
+    try:
+        snapshot = current_snapshot
+        return versioned_response(system_status_body, f'{snapshot.version}.{settings_version}',
+                                  max(snapshot.modified, settings_modified), build)
         
     except Exception as e:
         print(f"Error getting system status: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/clients')
+def get_clients():
+    """Socket.IO clients of this process with their subscription, lag and dropped frame counts"""
+    clients = device_rooms.stats(current_snapshot.version)
+    return jsonify({'clients': clients, 'count': len(clients), 'queue_limit': CLIENT_QUEUE_LIMIT})
+
+def merge_worker_metrics(ingest_text, worker_text):
+    """The ingest's exposition with WORKER_METRIC_FAMILIES taken from this web worker's instead"""
+    def families(text):
+        grouped = {}
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+            grouped.setdefault(name, []).append(line)
+        return grouped
+    worker = families(worker_text)
+    lines = []
+    for name, family in families(ingest_text).items():
+        lines += worker.get(name, family) if name in WORKER_METRIC_FAMILIES else family
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    writer = telemetry_writer.stats()
+    statistics = fleet_stats.summary()
+    clients = device_rooms.stats(current_snapshot.version)
+    counters = (
+        ('iot_telemetry_rows_written_total', 'Telemetry rows written to SQLite.', writer['rows_written']),
+        ('iot_telemetry_dropped_ticks_total', 'Ticks dropped because the writer queue was full.',
+         writer['dropped_ticks'])
+    )
+    gauges = (
+        ('iot_telemetry_writer_queue_depth', 'Ticks waiting for the telemetry writer.', writer['queue_depth']),
+        ('iot_devices', 'Devices in the fleet.', statistics['total_devices']),
+        ('iot_devices_online', 'Devices currently online.', statistics['online_devices']),
+        ('iot_devices_unreachable', 'Real devices with an open circuit.', count_unreachable_devices()),
+        ('iot_snapshot_version', 'Version of the last published device snapshot.', current_snapshot.version),
+        ('iot_socketio_clients_behind', 'Socket.IO clients skipped until their outbound queue drains.',
+         sum(client['behind'] for client in clients)),
+        ('iot_socketio_client_max_lag_ticks', 'Ticks since the furthest behind client was last sent a frame.',
+         max((client['lag_ticks'] for client in clients), default=0))
+    )
+    text = metrics.render(counters, gauges)
+    if ingest_url is not None:
+        try:
+            with urllib.request.urlopen(ingest_url + '/metrics', timeout=UPDATE_COMMAND_TIMEOUT) as reply:
+                ingest_text = reply.read().decode()
+        except urllib.error.URLError as e:
+            return jsonify({'success': False, 'error': f'Ingest process unavailable: {e.reason}'}), 503
+        text = merge_worker_metrics(ingest_text, text)
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @socketio.on('connect')
 def handle_connect():
     print(f'Client connected: {request.sid}')
-    # Send current device data to newly connected client
-    serializable_devices = serialize_device_data(devices_data)
-    emit('device_update', {
-        'devices': serializable_devices,
-        'timestamp': datetime.now().isoformat(),
-        'statistics': calculate_statistics()
-    })
+    metrics.count('clients')
+    # Watch the whole fleet until the client subscribes to something narrower
+    snapshot = current_snapshot
+    join_room(FLEET_ROOM)
+    device_rooms.join(request.sid, DeviceSelector(), snapshot)
+    # Send a full snapshot; later frames are deltas against it
+    emit('device_update', snapshot.full_frame())
+
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    """Narrow this client's device_update frames to a selector: {location, type, ids} filters that all
+    have to match, or {statistics: true} for statistics alone. An empty selector means the whole fleet."""
+    try:
+        selector = DeviceSelector.parse(data)
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}
+    snapshot = current_snapshot
+    # Built before joining, so a failure leaves the client where it was
+    full_frame = selector.full_frame(snapshot)
+    previous = device_rooms.join(request.sid, selector, snapshot)
+    if previous is not None and previous != selector.room:
+        leave_room(previous)
+    join_room(selector.room)
+    emit('device_update', full_frame)
+    return {'success': True, 'room': selector.room}
+
+@socketio.on('resync')
+def handle_resync():
+    """Resend a full snapshot to a client that missed a delta frame"""
+    snapshot = current_snapshot
+    emit('device_update', device_rooms.resynced(request.sid, snapshot).full_frame(snapshot))
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print(f'Client disconnected: {request.sid}')
+    metrics.count('clients', -1)
+    device_rooms.leave(request.sid)
 
 @socketio.on('ping')
 def handle_ping():
     emit('pong', {'timestamp': datetime.now().isoformat()})
 
-if __name__ == '__main__':
-    print("=" * 80)
-    print("CSE407 IoT Energy Monitoring Dashboard")
-    print("By Md Maruf Hasan | ID: 2021-3-60-101")
-    print("Dynamic IoT Dashboard for Real-time Device Monitoring and Control")
-    print("=" * 80)
-    
+def start_update_services():
+    """Load the fleet and settings and start the update loop with the threads around it"""
     # Initialize database and load data
     print("🔧 Initializing system...")
     init_database()
@@ -946,21 +3637,127 @@ if __name__ == '__main__':
     print(f"✓ Electricity rate: ৳{settings['electricity_rate']}/kWh")
     print(f"✓ Update interval: {settings['update_interval']} second(s)")
     print(f"✓ CSV file size limit: {settings['file_size_limit']}MB")
+    print(f"✓ CSV flush interval: {settings['csv_flush_interval']} second(s)")
     
     # Start background thread for device updates
     print("🔄 Starting background processes...")
+    telemetry_writer.start()
+    print("✓ Telemetry writer thread started")
+    csv_logger.start()
+    print("✓ CSV log flusher thread started")
+    device_io.start()
+    print("✓ Device I/O event loop started")
     update_thread = threading.Thread(target=update_devices, daemon=True)
     update_thread.start()
     print("✓ Device update thread started")
+
+def stop_update_services():
+    device_io.stop()
+    telemetry_writer.stop()
+    csv_logger.stop()
+
+def handle_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+def ignore_shutdown_signals():
+    """Let cleanup finish even if a second Ctrl-C or the supervisor's terminate() arrives meanwhile"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def run_ingest(ring_name, port):
+    """Ingest process of a split deployment: the update loop and device I/O, publishing into shared
+    memory; its API listens on loopback only, for the writes web workers forward"""
+    global shared_snapshot_writer
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    ring = SnapshotRing.create(ring_name)
+    shared_snapshot_writer = SharedSnapshotWriter(ring)
+    try:
+        start_update_services()
+        socketio.run(app, host='127.0.0.1', port=port, debug=False, allow_unsafe_werkzeug=True, log_output=False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ignore_shutdown_signals()
+        stop_update_services()
+        ring.close()
+
+def run_web(ring_name, host, port, ingest_port):
+    """Web worker of a split deployment: REST and Socket.IO clients served from the shared snapshots"""
+    global shared_snapshot_reader, ingest_url
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    while True:
+        try:
+            ring = SnapshotRing.attach(ring_name)
+            break
+        except FileNotFoundError:
+            time.sleep(SHARED_POLL_INTERVAL)  # the ingest process hasn't created it yet
+    shared_snapshot_reader = SharedSnapshotReader(ring)
+    ingest_url = f'http://127.0.0.1:{ingest_port}'
+    follower = threading.Thread(target=follow_shared_snapshots, name='shared-snapshots', daemon=True)
+    follower.start()
+    print(f"✓ Web worker {os.getpid()} listening on port {port}")
+    try:
+        socketio.run(app, host=host, port=port, debug=False, allow_unsafe_werkzeug=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ignore_shutdown_signals()
+        shared_snapshots_stopping.set()
+        follower.join()
+        ring.close()
+
+def run_split(web_workers, host, port):
+    """Start the ingest process and web workers on port, port + 1, ... and wait for them"""
+    context = get_context('spawn')
+    ring_name = f'iot-dashboard-{os.getpid()}'
+    processes = [context.Process(target=run_ingest, args=(ring_name, INGEST_PORT), name='ingest')]
+    processes += [
+        context.Process(target=run_web, args=(ring_name, host, port + worker, INGEST_PORT), name=f'web-{worker}')
+        for worker in range(web_workers)
+    ]
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        ignore_shutdown_signals()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CSE407 IoT Energy Monitoring Dashboard')
+    parser.add_argument('--port', type=int, default=5000, help='port to serve on (the first web worker\'s with --split)')
+    parser.add_argument('--split', action='store_true',
+                        help='run the update loop in an ingest process and serve clients from web worker processes')
+    parser.add_argument('--web-workers', type=int, default=1,
+                        help='web worker processes with --split, listening on consecutive ports')
+    args = parser.parse_args()
+    
+    print("=" * 80)
+    print("CSE407 IoT Energy Monitoring Dashboard")
+    print("By Md Maruf Hasan | ID: 2021-3-60-101")
+    print("Dynamic IoT Dashboard for Real-time Device Monitoring and Control")
+    print("=" * 80)
+    
+    if args.split:
+        print(f"🔀 Split mode: 1 ingest process, {args.web_workers} web worker(s) on ports "
+              f"{args.port}-{args.port + args.web_workers - 1}")
+    else:
+        start_update_services()
     
     print("=" * 80)
     print("🚀 Starting server...")
     print("📊 Dashboard will be available at:")
-    print("   • Local: http://localhost:5000")
-    print("   • Network: http://[your-ip]:5000")
+    print(f"   • Local: http://localhost:{args.port}")
+    print(f"   • Network: http://[your-ip]:{args.port}")
     print("\n🌐 For internet access, use one of these methods:")
-    print("   • ngrok: ngrok http 5000")
-    print("   • LocalTunnel: lt --port 5000")
+    print(f"   • ngrok: ngrok http {args.port}")
+    print(f"   • LocalTunnel: lt --port {args.port}")
     print("   • Port forwarding on your router")
     print("\n📝 Features:")
     print("   ✅ Real-time monitoring of 100+ devices")
@@ -975,10 +3772,15 @@ if __name__ == '__main__':
     
     # Run the app
     try:
-        socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
+        if args.split:
+            run_split(args.web_workers, '0.0.0.0', args.port)
+        else:
+            socketio.run(app, host='0.0.0.0', port=args.port, debug=False, allow_unsafe_werkzeug=True)
     except KeyboardInterrupt:
         print("\n🛑 Server stopped by user")
     except Exception as e:
         print(f"\n❌ Server error: {e}")
     finally:
+        if not args.split:
+            stop_update_services()
         print("👋 Goodbye!")
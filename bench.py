@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Tick pipeline benchmark for the IoT Energy Monitoring Dashboard
+
+Boots the app once per fleet size in a scratch directory, with real devices
+answered by a fake Tuya device, connects headless Socket.IO clients and runs
+the update loop's tick. Each run appends one JSON line per fleet size to the
+output file so results can be compared between commits.
+
+    python bench.py --sizes 100 1000 10000 100000 --ticks 20 --clients 4
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def rss_mb():
+    """Current and peak resident set size in MB"""
+    current = peak = None
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        # ru_maxrss is KB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return round(current if current is not None else peak, 1), round(peak, 1)
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'max': round(ordered[-1] * 1000, 3)
+    }
+
+class FakeTuyaConnection:
+    """Stands in for app.TuyaConnection: a smart plug that answers after a short delay and
+    pushes a power reading about once a second while connected"""
+    latency = 0.02
+    push_interval = 1.0
+
+    def __init__(self, dev_id, address=None, local_key=None, version=None):
+        self.dev_id = dev_id
+        self.on = True
+        self.energy = random.randint(0, 100000)
+        self.writer = None
+        self.last_received = 0.0
+        self.on_status = None
+
+    async def open(self):
+        await asyncio.sleep(self.latency)
+        self.writer = True
+        self.last_received = asyncio.get_running_loop().time()
+
+    def close(self):
+        self.writer = None
+
+    def reading(self):
+        self.energy += 1
+        power = random.randint(50, 1000) if self.on else 0
+        return {'1': self.on, '17': self.energy, '18': power * 45 // 10 if self.on else 2,
+                '19': power, '20': random.randint(2180, 2220)}
+
+    def receive(self, dps):
+        self.last_received = asyncio.get_running_loop().time()
+        self.on_status(dps)
+        return {'devId': self.dev_id, 'dps': dps}
+
+    async def listen(self, on_status):
+        self.on_status = on_status
+        while True:
+            await asyncio.sleep(self.push_interval * random.uniform(0.5, 1.5))
+            dps = self.reading()
+            self.receive({key: dps[key] for key in ('18', '19', '20')})
+
+    async def status(self):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        return self.receive(self.reading())
+
+    async def heartbeat(self):
+        await asyncio.sleep(self.latency)
+        self.last_received = asyncio.get_running_loop().time()
+        return {}
+
+    async def set_status(self, on, switch=1):
+        await asyncio.sleep(self.latency)
+        self.on = on
+        self.receive({str(switch): on})
+        return {}
+
+class StageTimer:
+    """Wraps functions the tick calls so each call's duration is recorded under a stage name"""
+
+    def __init__(self):
+        self.samples = {}
+        self.frame_bytes = []
+
+    def wrap(self, owner, attribute, stage):
+        original = getattr(owner, attribute)
+        samples = self.samples.setdefault(stage, [])
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - started)
+        setattr(owner, attribute, staticmethod(timed) if isinstance(owner, type) else timed)
+
+    def wrap_emit(self, socketio):
+        original = socketio.emit
+        def emit(event, *args, **kwargs):
+            if event == 'device_update' and args:
+                self.frame_bytes.append(len(args[0]) if isinstance(args[0], str) else len(json.dumps(args[0])))
+            return original(event, *args, **kwargs)
+        socketio.emit = emit
+
+def build_fleet(app, size, real):
+    """Fill the store with `size` devices, the first `real` of them polled through FakeTuyaConnection"""
+    device_types = list(app.SIM_POWER_RANGES)
+    locations = ['Office', 'Lab Room A', 'Lab Room B', 'Conference Room', 'Corridor', 'Library']
+    for i in range(1, size + 1):
+        device_id = f"device_{i:03d}"
+        if i <= real:
+            app.devices_data.add({
+                'id': device_id,
+                'name': f"Smart Plug #{i} (Fake)",
+                'type': 'Smart Plug',
+                'location': 'Lab Room A',
+                'ip_address': '127.0.0.1',
+                'tuya_device_id': f"fake{i:018d}",
+                'local_key': '0123456789abcdef',
+                'tuya_version': 3.5,
+                'is_real': True
+            }, status='online', voltage=220.0)
+        else:
+            app.devices_data.add({
+                'id': device_id,
+                'name': f"{random.choice(device_types)} #{i}",
+                'type': random.choice(device_types),
+                'location': random.choice(locations),
+                'is_real': False
+            },
+                status=random.choice(['online', 'online', 'online', 'offline']),
+                state=random.choice([True, False]),
+                voltage=round(random.uniform(210, 230), 1),
+                energy=round(random.uniform(0, 100), 3),
+                uptime=random.randint(0, 86400)
+            )
+    app.fleet_stats.rebuild()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def connect_clients(count, url):
+    """Headless Socket.IO clients recording the seq of every delta frame they receive"""
+    import socketio as socketio_client
+    received = [[] for _ in range(count)]
+    clients = []
+    for index in range(count):
+        client = socketio_client.Client(reconnection=False)
+        def on_update(data, seqs=received[index]):
+            if not data.get('full'):
+                seqs.append(data['seq'])
+        client.on('device_update', on_update)
+        client.connect(url, transports=['polling'], wait_timeout=10)
+        clients.append(client)
+    return clients, received
+
+def run_worker(args):
+    """Benchmark one fleet size in this process and return the result record"""
+    workdir = tempfile.mkdtemp(prefix='iot-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    rss_start, _ = rss_mb()
+
+    import app
+    FakeTuyaConnection.latency = args.tuya_latency
+    app.TuyaConnection = FakeTuyaConnection
+    app.init_database()
+    app.load_settings_from_db()
+    app.settings['update_interval'] = args.interval
+
+    real = min(args.real, args.size)
+    started = time.perf_counter()
+    build_fleet(app, args.size, real)
+    fleet_seconds = time.perf_counter() - started
+    rss_fleet, _ = rss_mb()
+
+    app.telemetry_writer.start()
+    app.csv_logger.start()
+    app.device_io.start()
+    port = free_port()
+    server = threading.Thread(target=app.socketio.run, args=(app.app,), kwargs={
+        'host': '127.0.0.1', 'port': port, 'allow_unsafe_werkzeug': True, 'log_output': False
+    }, daemon=True)
+    server.start()
+    time.sleep(0.5)
+    clients, received = connect_clients(args.clients, f"http://127.0.0.1:{port}")
+
+    timer = StageTimer()
+    timer.wrap(app, 'poll_real_devices', 'poll')
+    timer.wrap(app.sim_fleet, 'tick', 'simulate')
+    timer.wrap(app.fleet_stats, 'update_rows', 'statistics')
+    timer.wrap(app, 'log_data_to_csv', 'csv')
+    timer.wrap(app, 'save_historical_data_to_db', 'db')
+    timer.wrap(app, 'publish_device_update', 'publish')
+    timer.wrap(app, 'calculate_statistics', 'publish.statistics')
+    timer.wrap(app.DeviceSnapshot, 'capture', 'publish.snapshot')
+    timer.wrap(app, 'build_device_delta', 'publish.delta')
+    timer.wrap(app.socketio, 'emit', 'publish.emit')
+    timer.wrap_emit(app.socketio)
+
+    # The first tick sends every device in full; keep it out of the steady-state numbers
+    for _ in range(args.warmup):
+        app.update_tick(datetime.now())
+    for samples in timer.samples.values():
+        samples.clear()
+    timer.frame_bytes.clear()
+    first_seq = app.current_snapshot.version + 1
+
+    tick_samples = []
+    ticks_started = time.perf_counter()
+    for _ in range(args.ticks):
+        started = time.perf_counter()
+        app.update_tick(datetime.now())
+        elapsed = time.perf_counter() - started
+        tick_samples.append(elapsed)
+        time.sleep(max(0.0, args.interval - elapsed))
+    ticks_seconds = time.perf_counter() - ticks_started
+    time.sleep(min(2.0, args.interval * 2))
+    frames_received = sum(1 for seqs in received for seq in seqs if seq >= first_seq)
+    rss_end, rss_peak = rss_mb()
+
+    for client in clients:
+        client.disconnect()
+    app.device_io.stop()
+    started = time.perf_counter()
+    app.csv_logger.stop()
+    app.telemetry_writer.stop()
+    drain_seconds = time.perf_counter() - started
+    writer = app.telemetry_writer.stats()
+
+    frame_bytes = timer.frame_bytes
+    return {
+        'devices': args.size,
+        'real_devices': real,
+        'clients': args.clients,
+        'ticks': args.ticks,
+        'interval_s': args.interval,
+        'fleet_build_s': round(fleet_seconds, 3),
+        'tick_ms': summarize(tick_samples),
+        'overruns': sum(1 for sample in tick_samples if sample > args.interval),
+        'stages_ms': {stage: summarize(samples) for stage, samples in sorted(timer.samples.items())},
+        'frame_bytes': {
+            'mean': round(sum(frame_bytes) / len(frame_bytes)) if frame_bytes else 0,
+            'max': max(frame_bytes, default=0),
+            'total': sum(frame_bytes)
+        },
+        'emitted_bytes': sum(frame_bytes) * args.clients,
+        'frames_received': frames_received,
+        'frames_expected': len(frame_bytes) * args.clients,
+        'db': {
+            'rows_written': writer['rows_written'],
+            'dropped_ticks': writer['dropped_ticks'],
+            'writer_rows_per_second': writer['rows_per_second'],
+            'rows_per_second': round(writer['rows_written'] / (ticks_seconds + drain_seconds)),
+            'drain_s': round(drain_seconds, 3)
+        },
+        'rss_mb': {'start': rss_start, 'fleet': rss_fleet, 'end': rss_end, 'peak': rss_peak}
+    }
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard update tick at several fleet sizes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--ticks', type=int, default=20, help='measured ticks per fleet size')
+    parser.add_argument('--warmup', type=int, default=1, help='ticks run before measuring')
+    parser.add_argument('--clients', type=int, default=4, help='headless Socket.IO clients')
+    parser.add_argument('--real', type=int, default=10, help='devices polled through the fake Tuya device')
+    parser.add_argument('--tuya-latency', type=float, default=0.02, help='seconds a fake Tuya status() takes')
+    parser.add_argument('--interval', type=int, default=1, help='seconds between ticks (the update_interval setting)')
+    parser.add_argument('--output', default=os.path.join(REPO_DIR, 'bench_output.txt'),
+                        help='file results are appended to as JSON lines')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # App chatter goes to stderr; stdout carries only the result line
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_worker(args)
+        print(json.dumps(result))
+        sys.stdout.flush()
+        os._exit(0)  # don't wait on the server thread
+
+    run = {
+        'bench': 'tick_pipeline',
+        'revision': git_revision(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+    forwarded = ['--ticks', str(args.ticks), '--warmup', str(args.warmup), '--clients', str(args.clients),
+                 '--real', str(args.real), '--tuya-latency', str(args.tuya_latency),
+                 '--interval', str(args.interval)]
+    failed = False
+    for size in args.sizes:
+        print(f"Benchmarking {size} devices...", file=sys.stderr)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', '--size', str(size)] + forwarded,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        lines = proc.stdout.strip().splitlines()
+        if proc.returncode != 0 or not lines:
+            print(f"  failed (exit code {proc.returncode})", file=sys.stderr)
+            print('\n'.join(proc.stderr.strip().splitlines()[-10:]), file=sys.stderr)
+            record = dict(run, devices=size, error=f"worker exited with {proc.returncode}")
+            failed = True
+        else:
+            record = dict(run, **json.loads(lines[-1]))
+            tick = record['tick_ms']
+            print(f"  tick p50 {tick['p50']} ms, p95 {tick['p95']} ms, "
+                  f"frame {record['frame_bytes']['mean']} B, "
+                  f"db {record['db']['rows_per_second']} rows/s, rss {record['rss_mb']['end']} MB",
+                  file=sys.stderr)
+        print(json.dumps(record))
+        with open(args.output, 'a') as output:
+            output.write(json.dumps(record) + '\n')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()